@@ -1,7 +1,13 @@
 import pandas as pd
+import numpy as np
 from datetime import date
 import re
+import json
+import os
 import unicodedata
+import hashlib
+import inspect
+from collections import OrderedDict
 import text_unidecode as unidecode
 
 def enrollment_dates(x):
@@ -25,6 +31,41 @@ def enrollment_dates(x):
     else:
         return pd.to_datetime(x, errors='coerce')
 
+#Same checks as enrollment_dates, in the same order, as one anchored alternation so the format of every value
+#is detected in a single pass. The alpha-leading check sits between %b-%y and the numeric formats but can't
+#overlap with the numeric ones so it is handled separately.
+enrollment_formats = [('%b-%y', r"\w{3}-\d{2}"), ('%Y/%m/%d', r"\d{4}/\d{2}/\d{2}"), 
+                      ('%d/%m/%Y', r"\d{2}/\d{2}/\d{4}"), ('%Y-%m-%d', r"\d{4}-\d{2}-\d{2}"), 
+                      ('%d-%m-%Y', r"\d{2}-\d{2}-\d{4}")]
+
+def parse_enrollment_dates(s):
+    values = pd.Series(list(s), dtype=object)
+    out = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    is_str = values.map(lambda x: isinstance(x, str))
+    strs = values[is_str]
+    
+    detected = strs.str.extract('^(?:' + '|'.join(f'(?P<f{i}>{p})' for i, (_, p) in enumerate(enrollment_formats)) + ')')
+    matched = detected.notnull()
+    alpha = ~matched['f0'] & strs.str[:1].str.isalpha()
+    
+    for i, (fmt, _) in enumerate(enrollment_formats):
+        m = matched[f'f{i}'] & ~alpha
+        if m.any():
+            out[m[m].index] = pd.to_datetime(strs[m], format=fmt)
+    
+    #Anything without a fixed format is parsed once per unique value rather than once per row
+    other = ~matched.any(axis=1) & ~alpha
+    for m, errors in [(alpha, 'raise'), (other, 'coerce')]:
+        if m.any():
+            parsed = {v: pd.to_datetime(v, errors=errors) for v in strs[m].unique()}
+            out[m[m].index] = pd.to_datetime(strs[m].map(parsed))
+    
+    if (~is_str).any():
+        out[~is_str] = pd.to_datetime(values[~is_str], errors='coerce')
+    
+    out.index = s.index if isinstance(s, pd.Series) else out.index
+    return out
+
 
 def fix_date(x):
     if isinstance(x,str):
@@ -42,7 +83,166 @@ def fix_errors(fix_dict, df):
             else:
                 print(f'Original Value Did not Match for {a}')
     return df
+
+correction_cols = ['TrialID', 'column', 'old_value', 'new_value']
+
+def apply_corrections(df, corrections):
+    #Bulk version of fix_errors for any column. Each correction is matched to the first row for its TrialID 
+    #through a single hashed lookup and is only applied if the current value still matches old_value.
+    #Returns the corrected df and a report of the corrections that weren't applied.
+    fixes = pd.DataFrame(corrections, columns=correction_cols).reset_index(drop=True)
+    first_row = pd.Series(np.arange(len(df)), index=df.TrialID.values)
+    first_row = first_row[~first_row.index.duplicated()]
+    fixes['row'] = fixes.TrialID.map(first_row)
+    fixes['current_value'] = None
+    fixes['status'] = None
+    fixes.loc[fixes.row.isnull(), 'status'] = 'TrialID Not Found'
+    fixes.loc[fixes.row.notnull() & ~fixes.column.isin(df.columns), 'status'] = 'Column Not Found'
+    
+    for col, grp in fixes[fixes.status.isnull()].groupby('column'):
+        rows = grp.row.astype(int).values
+        current = df[col].values[rows]
+        fixes.loc[grp.index, 'current_value'] = pd.Series(current, index=grp.index, dtype=object)
+        match = np.array([str(a) == str(b) for a, b in zip(current, grp.old_value)], dtype=bool)
+        fixes.loc[grp.index[~match], 'status'] = 'Original Value Did Not Match'
+        fixes.loc[grp.index[match], 'status'] = 'Applied'
+        if match.any():
+            df.iloc[rows[match], df.columns.get_loc(col)] = grp.new_value.values[match]
+    
+    report = fixes[fixes.status != 'Applied'].drop('row', axis=1).reset_index(drop=True)
+    return df, report
+    
+def cross_reg_retrospective(df, c_reg, ictrp=None):
+    #Re-flags retrospective registration for trials with known cross registrations using the earliest 
+    #registration date across all of their registrations. Registration and enrollment dates come from the 
+    #ictrp frame (defaults to df) and the flag is updated in df.
+    if ictrp is None:
+        ictrp = df
+    earliest = c_reg.groupby('trial_id_keep').cross_reg_date.min()
+    dates = ictrp[['TrialID', 'Date_registration', 'Date_enrollement']].drop_duplicates('TrialID')
+    dates = dates.merge(earliest, left_on='TrialID', right_index=True, how='inner').set_index('TrialID')
+    earliest_reg = dates[['cross_reg_date', 'Date_registration']].min(axis=1)
+    retrospective = earliest_reg > dates['Date_enrollement']
+    
+    flags = df.TrialID.map(retrospective)
+    has_flag = flags.notnull()
+    df.loc[has_flag.values, 'retrospective_registration'] = flags[has_flag].astype(bool).values
+    return df
+
+#Columns we keep from the raw ICTRP export and what we rename them to
+ictrp_cols = ['TrialID', 'Source Register', 'Date registration', 'Date enrollement', 'retrospective_registration', 
+              'Primary sponsor', 'Recruitment Status', 'Phase', 'Study type', 'Countries', 'Public title', 
+              'Intervention', 'target_enrollment', 'target_enrollment_not_available', 'web address', 
+              'results yes no', 'results url link']
+
+ictrp_col_names = ['TrialID', 'Source_Register', 'Date_registration', 'Date_enrollement', 
+                   'retrospective_registration', 'Primary_sponsor', 'Recruitment_Status', 'Phase', 'Study_type', 
+                   'Countries', 'Public_title', 'Intervention', 'target_enrollment', 
+                   'target_enrollment_not_available', 'web_address', 'has_results', 'results_url_link']
+
+def clean_ictrp(df):
+    #The row-level cleaning of the raw ICTRP export. Every step only depends on the row itself so it can be
+    #run on any subset of trials.
+    df = df.copy()
+    df['Date enrollement'] = parse_enrollment_dates(df['Date enrollement'])
+    df['Date registration'] = pd.to_datetime(df['Date registration3'], format='%Y%m%d')
+    df['target_enrollment'], df['target_enrollment_not_available'] = extract_target_size(df['Target size'])
+    df['retrospective_registration'] = np.where(df['Date registration'] > df['Date enrollement'], True, False)
+    
+    df_cond = df[ictrp_cols].reset_index(drop=True)
+    df_cond.columns = ictrp_col_names
+    return df_cond
+
+#The raw columns clean_ictrp needs. Everything is read as text and parsed by clean_ictrp.
+ictrp_raw_cols = ['TrialID', 'Source Register', 'Date registration3', 'Date enrollement', 'Primary sponsor', 
+                  'Recruitment Status', 'Phase', 'Study type', 'Countries', 'Public title', 'Intervention', 
+                  'Target size', 'web address', 'results yes no', 'results url link']
+
+ictrp_raw_dtypes = {c: str for c in ictrp_raw_cols}
+
+def stream_clean_ictrp(path, out_path, corrections=None, chunksize=50000):
+    #Cleans an ICTRP export of any size in fixed-size chunks, appending each cleaned chunk to out_path so 
+    #only one chunk is ever held in memory. Returns the number of trials written and the corrections 
+    #that couldn't be applied in any chunk.
+    reports = []
+    n_chunks = 0
+    n_rows = 0
+    for chunk in pd.read_csv(path, usecols=ictrp_raw_cols, dtype=ictrp_raw_dtypes, chunksize=chunksize):
+        if corrections is not None:
+            chunk, report = apply_corrections(chunk, corrections)
+            reports.append(report)
+        cleaned = clean_ictrp(chunk)
+        cleaned.to_csv(out_path, mode='w' if n_chunks == 0 else 'a', header=(n_chunks == 0), index=False)
+        n_chunks += 1
+        n_rows += len(cleaned)
+    
+    if not reports:
+        return n_rows, pd.DataFrame(columns=correction_cols + ['current_value', 'status'])
+    #A correction was applied if it is missing from any chunk's report. Value mismatches are more useful 
+    #to report than the chunks where the trial didn't appear.
+    report = pd.concat(reports, ignore_index=True)
+    report['n'] = report.groupby(['TrialID', 'column']).TrialID.transform('size')
+    report['found'] = report.status != 'TrialID Not Found'
+    report = report[report.n == n_chunks].sort_values('found', ascending=False, kind='mergesort')
+    report = report.drop_duplicates(['TrialID', 'column']).drop(['n', 'found'], axis=1)
+    return n_rows, report.reset_index(drop=True)
+
+def row_hashes(df, id_col='TrialID', cols=None):
+    #A content hash of every raw row, keyed on TrialID. Trials with more than one row get one combined hash.
+    #With cols only those columns are hashed, so columns that change with every export (like the export date) 
+    #don't make every trial look changed.
+    if cols is not None:
+        df = df[[id_col] + [c for c in cols if c != id_col]]
+    hashes = pd.Series(pd.util.hash_pandas_object(df, index=False).values.astype(str), index=df[id_col].values)
+    dup = hashes.index.duplicated(keep=False)
+    if dup.any():
+        combined = hashes[dup].groupby(level=0).agg('|'.join)
+        hashes = pd.concat([hashes[~dup], combined])
+    return hashes.rename('row_hash').rename_axis(id_col)
+
+def snapshot_delta(new_hashes, old_hashes=None):
+    #Compares two sets of row_hashes and lists the added, changed and removed trials
+    if old_hashes is None:
+        old_hashes = pd.Series(dtype=str)
+    both = pd.DataFrame({'new': new_hashes, 'old': old_hashes})
+    status = pd.Series(None, index=both.index, dtype=object)
+    status[both.old.isnull()] = 'added'
+    status[both.new.isnull()] = 'removed'
+    status[both.new.notnull() & both.old.notnull() & (both.new != both.old)] = 'changed'
+    delta = status.dropna().rename('status').rename_axis(new_hashes.index.name or 'TrialID')
+    return delta.reset_index()
+
+def incremental_clean(raw, clean_fn, previous_cleaned=None, previous_hashes=None, id_col='TrialID', cols=None, 
+                      version=None, previous_version=None):
+    #Only re-runs clean_fn on trials that are new or whose raw row (or just its cols) has changed since the 
+    #previous snapshot and merges them into the previous cleaned output. If the cleaning code's version differs 
+    #from the one the previous output was made with, everything is cleaned again. Returns the cleaned frame, the 
+    #hashes to store for next time and the delta report.
+    hashes = row_hashes(raw, id_col, cols)
+    delta = snapshot_delta(hashes, previous_hashes)
+    if previous_cleaned is None or previous_hashes is None or version != previous_version:
+        return clean_fn(raw), hashes, delta
+    
+    touched = delta[id_col]
+    cleaned_new = clean_fn(raw[raw[id_col].isin(touched)])
+    kept = previous_cleaned[previous_cleaned[id_col].isin(hashes.index) & ~previous_cleaned[id_col].isin(touched)]
+    cleaned = pd.concat([kept, cleaned_new], ignore_index=True)
     
+    #Keep the row order of the new snapshot
+    order = pd.Series(np.arange(len(hashes)), index=pd.unique(raw[id_col]))
+    cleaned = cleaned.iloc[np.argsort(cleaned[id_col].map(order).values, kind='stable')].reset_index(drop=True)
+    return cleaned, hashes, delta
+
+def code_version(fns, *constants):
+    #A hash of the source of some functions and the lists they use, so stored output can be tied to the code 
+    #that made it
+    source = ''.join(inspect.getsource(f) for f in fns) + json.dumps(constants)
+    return hashlib.sha1(source.encode()).hexdigest()
+
+def ictrp_clean_version():
+    return code_version([clean_ictrp, parse_enrollment_dates, extract_target_size], enrollment_formats, 
+                        ictrp_cols, ictrp_col_names)
+
 def d_c(x):
     return x[x.TrialID.duplicated()]
 
@@ -66,10 +266,183 @@ def enroll_extract(e_list):
                 raise 
     return extracted_size
 
+def extract_target_size(s):
+    #Series version of enroll_extract. Returns the target sizes as a nullable integer column alongside a flag 
+    #for the entries enroll_extract would have called 'Not Available' (which are <NA> in the sizes).
+    values = pd.Series(list(s), dtype=object)
+    sizes = pd.Series(pd.NA, index=values.index, dtype='Int64')
+    is_str = values.map(lambda x: isinstance(x, str))
+    
+    missing = values.isnull() | (is_str & (values == ''))
+    numbers = ~is_str & ~missing
+    if numbers.any():
+        try:
+            sizes[numbers] = np.trunc(pd.to_numeric(values[numbers])).astype('int64')
+        except (ValueError, TypeError):
+            bad = values[numbers].map(type).unique()
+            raise TypeError(f'Unsupported Type: {bad}')
+    
+    strs = values[is_str & ~missing]
+    whole = strs.str.match(r'^\s*[+-]?\d+\s*$')
+    sizes[whole[whole].index] = strs[whole].str.strip().astype('int64')
+    
+    #Multi-group sizes are stored like 'Group 1:50;Group 2:50;' and the groups are summed
+    grouped = strs[~whole]
+    nums = grouped.str.extractall(r':(\d{1,10});')[0].astype('int64')
+    sizes[grouped.index] = nums.groupby(level=0).sum().reindex(grouped.index, fill_value=0)
+    
+    not_available = missing
+    if isinstance(s, pd.Series):
+        sizes.index = s.index
+        not_available.index = s.index
+    return sizes, not_available
+
 def norm_names(x):
     if isinstance(x,float):
         return x
     else:
         text = unidecode.unidecode(x)
         normed = unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode()
-        return normed 
\ No newline at end of file
+        return normed
+
+#Normalised names are kept in a bounded LRU cache shared by every column in the session and optionally saved 
+#to disk so the next run only has to normalise names it hasn't seen before
+norm_cache = OrderedDict()
+
+def load_norm_cache(path):
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            norm_cache.update(json.load(f))
+
+def save_norm_cache(path, maxsize=100000):
+    while len(norm_cache) > maxsize:
+        norm_cache.popitem(last=False)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(norm_cache, f, ensure_ascii=False)
+
+def cached_norm_name(x):
+    if x in norm_cache:
+        norm_cache.move_to_end(x)
+        return norm_cache[x]
+    normed = norm_names(x)
+    norm_cache[x] = normed
+    return normed
+
+def norm_names_categorical(s, cache_path=None, maxsize=100000):
+    #norm_names applied once per unique value (Primary_sponsor, Countries, Public_title etc.)
+    #rather than once per row, returned as a Categorical
+    if cache_path and not norm_cache:
+        load_norm_cache(cache_path)
+    is_str = s.map(lambda x: isinstance(x, str))
+    mapping = {u: cached_norm_name(u) for u in pd.unique(s[is_str])}
+    while len(norm_cache) > maxsize:
+        norm_cache.popitem(last=False)
+    if cache_path:
+        save_norm_cache(cache_path, maxsize)
+    return pd.Categorical(s.map(mapping).where(is_str, s))
+
+#Country alias -> canonical name. Canonical values containing ';' expand to several countries.
+country_aliases = {
+    'Chian': 'China', 'China?': 'China', 'Chinese': 'China', 'Wuhan': 'China', 'Chinaese': 'China', 'china': 'China', 
+    'Taiwan, Province Of China': 'China', "The People's Republic of China": 'China',
+    'Iran (Islamic Republic of)': 'Iran', 'Iran, Islamic Republic of': 'Iran',
+    'Viet nam': 'Vietnam', 'Viet Nam': 'Vietnam',
+    'Korea, Republic of': 'South Korea', 'Korea, Republic Of': 'South Korea', 'KOREA': 'South Korea',
+    'USA': 'United States', 'United States of America': 'United States', 'U.S.': 'United States',
+    'Japan,Asia(except Japan),Australia,Europe': 'Japan;Australia;Asia;Europe',
+    'Japan,Asia(except Japan),North America,South America,Australia,Europe,Africa': 
+    'Japan, Asia(except Japan), North America, South America, Australia, Europe, Africa',
+    'Japan,North America': 'Japan;North America',
+    'The Netherlands': 'Netherlands', 'England': 'United Kingdom', 'Czechia': 'Czech Republic',
+    'ASIA': 'Asia', 'EUROPE': 'Europe', 'MALAYSIA': 'Malaysia',
+    'Congo': 'Democratic Republic of Congo', 'Congo, Democratic Republic': 'Democratic Republic of Congo', 
+    'Congo, The Democratic Republic of the': 'Democratic Republic of Congo',
+    "C√¥te D'Ivoire": "Cote d'Ivoire", 'Cote Divoire': "Cote d'Ivoire"
+}
+
+def normalize_countries(df, aliases=country_aliases, col='Countries', id_col='TrialID'):
+    #Splits the ';' separated countries, maps every alias through the alias table (a dict or a DataFrame with
+    #'alias' and 'canonical' columns), dedupes within each trial and re-joins with ', '.
+    #Also returns the exploded trial -> country bridge table.
+    if isinstance(aliases, pd.DataFrame):
+        aliases = dict(zip(aliases['alias'], aliases['canonical']))
+    raw = pd.Series(df[col].values).fillna('No Country Given').replace('??', 'No Country Given')
+    parts = raw.str.split(';').explode().str.strip()
+    parts = parts.map(aliases).fillna(parts).str.split(';').explode().str.strip()
+    exploded = pd.DataFrame({'row': parts.index, 'country': parts.values})
+    exploded = exploded[exploded.country != ''].drop_duplicates()
+    
+    countries = (exploded.groupby('row').country.agg(', '.join)
+                 .reindex(raw.index, fill_value='No Country Given').rename(col))
+    countries.index = df.index
+    bridge = pd.DataFrame({id_col: df[id_col].values[exploded.row.values], 
+                           'country': exploded.country.values})
+    return countries, bridge
+
+#Controlled vocabularies as canonical value -> aliases. Canonical values with no aliases are still listed so
+#they aren't reported as unmapped.
+phase_vocab = {
+    'Not Applicable': ['0', 'Retrospective study', 'Not applicable', 'New Treatment Measure Clinical Study', 
+                       'Not selected', 'Phase 0', 'Diagnostic New Technique Clincal Study', 
+                       '0 (exploratory trials)', 'Not Specified'],
+    'Phase 1': ['1', 'Early Phase 1', 'I', 'Phase-1', 'Phase I'],
+    'Phase 1/Phase 2': ['1-2', '2020-02-01 00:00:00', 'Phase I/II', 'Phase 1 / Phase 2', 'Phase 1/ Phase 2',
+                        'Human pharmacology (Phase I): yes\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): no\n'],
+    'Phase 2': ['2', 'II', 'Phase II', 'IIb', 'Phase-2', 'Phase2',
+                'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): no\n'],
+    'Phase 2/Phase 3': ['Phase II/III', '2020-03-02 00:00:00', 'II-III', 'Phase 2 / Phase 3', 'Phase 2/ Phase 3', '2-3',
+                        'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): no\n'],
+    'Phase 3': ['3', 'Phase III', 'Phase-3', 'III',
+                'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): no\n'],
+    'Phase 3/Phase 4': ['Phase 3/ Phase 4', 'Phase III/IV',
+                        'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): yes\n'],
+    'Phase 4': ['4', 'IV', 'Post Marketing Surveillance', 'Phase IV', 'PMS',
+                'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): yes\n']
+}
+
+study_type_vocab = {
+    'Observational': ['Observational [Patient Registry]', 'observational', 'Observational Study'],
+    'Interventional': ['interventional', 'Interventional clinical trial of medicinal product', 'Treatment', 
+                       'INTERVENTIONAL', 'Intervention', 'Interventional Study', 'PMS'],
+    'Epidemiological research': ['Epidemilogical research'],
+    'Health services research': ['Health services reaserch', 'Health Services reaserch', 'Health Services Research'],
+    'Other': ['Others,meta-analysis etc'],
+    'Diagnostic test': [], 'Expanded Access': [], 'Basic Science': [], 'Prevention': [], 'Prognosis': [], 
+    'Screening': [], 'Unknown': []
+}
+
+recruitment_vocab = {
+    'Not Recruiting': ['Not recruiting'],
+    'Recruiting': [], 'Authorised': [], 'No Status Given': []
+}
+
+def compile_vocab(vocab):
+    #Flattens canonical -> aliases into one alias -> canonical lookup. If an alias is listed more than once 
+    #the first canonical value wins, as it would with chained .replace() calls.
+    lookup = {c: c for c in vocab}
+    for canonical, aliases in vocab.items():
+        for a in aliases:
+            lookup.setdefault(a, canonical)
+    return lookup
+
+def normalize_vocab(s, vocab, fill_value=None, preprocess=None):
+    #Maps a column onto a controlled vocabulary in one pass over its categories. preprocess is applied to 
+    #each unique string before lookup. Returns the Categorical result and a count of every value that 
+    #isn't in the vocabulary, which are left as they are.
+    lookup = compile_vocab(vocab)
+    if fill_value is not None:
+        s = s.fillna(fill_value)
+    codes, uniques = pd.factorize(s)
+    cleaned = [preprocess(u) if (preprocess and isinstance(u, str)) else u for u in uniques]
+    mapped = [lookup.get(c, c) for c in cleaned]
+    
+    categories = pd.Index(mapped).unique()
+    remap = categories.get_indexer(mapped)
+    #An all-missing column has nothing to remap and its codes are already all -1
+    new_codes = np.where(codes == -1, -1, remap[codes.clip(0)]) if len(remap) else codes
+    result = pd.Categorical.from_codes(new_codes, categories)
+    
+    counts = np.bincount(codes[codes != -1], minlength=len(uniques))
+    unmapped = pd.DataFrame({'value': cleaned, 'count': counts})
+    unmapped = unmapped[np.array([c not in lookup for c in cleaned], dtype=bool)]
+    return result, unmapped.sort_values('count', ascending=False).reset_index(drop=True)
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+from io import BytesIO
+import requests
+from datetime import date, datetime, timedelta
+from pandas import DataFrame
+from lib.id_searches import (iter_pubmed_xml, PubmedArchiveWriter, read_pubmed_archive, upsert_pubmed_archive, 
+                             edat_query, query)
+
+eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+
+#NCBI allows 3 requests a second, or 10 with an API key
+def rate_limit(api_key=None):
+    return 10 if api_key else 3
+
+class Throttle:
+    #Spaces out the start of requests so we never go over the per second limit. The margin leaves some slack 
+    #because the server counts requests by when they arrive, which can bunch up more than when they were sent.
+    def __init__(self, per_second, margin=0.1):
+        self.interval = (1 + margin) / per_second
+        self.next_start = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+            self.next_start = max(now, self.next_start) + self.interval
+
+class EutilsClient:
+    #Runs an esearch with the history server and then fetches the results in concurrent efetch batches. The
+    #requests themselves run in threads; asyncio keeps a fixed number in flight and throttles them.
+    def __init__(self, email=None, api_key=None, base_url=eutils_url, concurrency=3, per_second=None, retries=3):
+        self.base_url = base_url
+        self.params = {'db': 'pubmed', 'tool': 'covid19_results_reporting'}
+        if email:
+            self.params['email'] = email
+        if api_key:
+            self.params['api_key'] = api_key
+        self.throttle = None
+        self.per_second = per_second or rate_limit(api_key)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.session = requests.Session()
+        self.counters = {'requests': 0, 'retries': 0, 'batches': 0, 'records': 0}
+
+    async def get(self, endpoint, params):
+        if self.throttle is None:
+            self.throttle = Throttle(self.per_second)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            await self.throttle.wait()
+            self.counters['requests'] += 1
+            response = await loop.run_in_executor(
+                None, lambda: self.session.get(f'{self.base_url}/{endpoint}', params={**self.params, **params}))
+            #NCBI answers 429 when over the rate limit and sometimes 5xx under load, both worth retrying
+            if response.status_code == 429 or response.status_code >= 500:
+                self.counters['retries'] += 1
+                await asyncio.sleep(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response
+        response.raise_for_status()
+
+    async def esearch(self, query, **search_params):
+        #Returns the number of results and the history server keys for them
+        response = await self.get('esearch.fcgi', {'term': query, 'usehistory': 'y', 'retmode': 'json', 'retmax': 0,
+                                                   **search_params})
+        result = response.json()['esearchresult']
+        return int(result['count']), result['webenv'], result['querykey']
+
+    async def efetch(self, webenv, query_key, retstart, retmax):
+        response = await self.get('efetch.fcgi', {'WebEnv': webenv, 'query_key': query_key, 'retstart': retstart,
+                                                  'retmax': retmax, 'retmode': 'xml'})
+        return list(iter_pubmed_xml(BytesIO(response.content), keep_xml=True))
+
+    async def harvest(self, query, write, batch_size=250, max_results=None, queue_size=None, **search_params):
+        #Fetches every result of the query and passes each batch of archive records to write as it arrives.
+        #Batches wait in a bounded queue, so if writing falls behind the fetchers stop until it catches up.
+        count, webenv, query_key = await self.esearch(query, **search_params)
+        if max_results is not None:
+            count = min(count, max_results)
+        starts = iter(range(0, count, batch_size))
+        queue = asyncio.Queue(maxsize=queue_size or self.concurrency)
+
+        async def fetcher():
+            for retstart in starts:
+                records = await self.efetch(webenv, query_key, retstart, min(batch_size, count - retstart))
+                await queue.put(records)
+
+        async def writer():
+            loop = asyncio.get_running_loop()
+            while True:
+                records = await queue.get()
+                if records is None:
+                    return
+                await loop.run_in_executor(None, write, records)
+                self.counters['batches'] += 1
+                self.counters['records'] += len(records)
+
+        async def fetch_all():
+            await asyncio.gather(*[fetcher() for _ in range(self.concurrency)])
+            await queue.put(None)
+
+        await asyncio.gather(fetch_all(), writer())
+        return self.counters
+
+def fetch_pubmed_archive(query, archive_path, email=None, api_key=None, **kwargs):
+    #Streams every result of a PubMed query straight into a columnar archive. Returns the client's counters.
+    client = EutilsClient(email=email, api_key=api_key, base_url=kwargs.pop('base_url', eutils_url),
+                          concurrency=kwargs.pop('concurrency', 3), per_second=kwargs.pop('per_second', None))
+    with PubmedArchiveWriter(archive_path) as writer:
+        return asyncio.run(client.harvest(query, writer.write, **kwargs))
+
+#Updating an archive only fetches what PubMed added since the last harvest (by EDAT, with a day of overlap) 
+#plus anything modified since then (by MDAT), and upserts it by PMID. The last dates are kept next to the archive.
+def harvest_state_path(archive_path):
+    return archive_path + '.state.json'
+
+def load_harvest_state(archive_path):
+    try:
+        with open(harvest_state_path(archive_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        #An archive from a full search: start from its latest EDAT
+        edat = read_pubmed_archive(archive_path, columns=['edat']).edat.dropna().max()
+        return {'last_edat': edat.strftime('%Y/%m/%d'), 'last_harvest': edat.strftime('%Y/%m/%d')}
+
+def update_pubmed_archive(archive_path, email=None, api_key=None, base_query=query, overlap_days=1, **kwargs):
+    #Returns each fetched PMID with whether it was new, revised or unchanged, for rescanning
+    state = load_harvest_state(archive_path)
+    start = (datetime.strptime(state['last_edat'], '%Y/%m/%d') - timedelta(days=overlap_days)).strftime('%Y/%m/%d')
+    today = date.today().strftime('%Y/%m/%d')
+    client = EutilsClient(email=email, api_key=api_key, base_url=kwargs.pop('base_url', eutils_url),
+                          concurrency=kwargs.pop('concurrency', 3), per_second=kwargs.pop('per_second', None))
+    updates_path = archive_path + '.updates'
+
+    async def harvest_updates(write):
+        await client.harvest(edat_query(start, base_query=base_query), write, **kwargs)
+        await client.harvest(base_query, write, datetype='mdat', mindate=state['last_harvest'], maxdate=today,
+                             **kwargs)
+
+    with PubmedArchiveWriter(updates_path) as writer:
+        asyncio.run(harvest_updates(writer.write))
+    if writer.rows:
+        changes = upsert_pubmed_archive(archive_path, updates_path)
+    else:
+        changes = DataFrame({'pmid': [], 'status': []})
+    os.remove(updates_path)
+
+    edat = read_pubmed_archive(archive_path, columns=['edat']).edat.dropna().max()
+    with open(harvest_state_path(archive_path), 'w') as f:
+        json.dump({'last_edat': edat.strftime('%Y/%m/%d'), 'last_harvest': today}, f)
+    return changes
@@ -1,10 +1,24 @@
 from zipfile import ZipFile
-from pandas import read_csv, DataFrame
+from concurrent.futures import ProcessPoolExecutor
+import os
+import json
+import hashlib
+import zlib
+import sqlite3
+from pandas import read_csv, DataFrame, Series, concat
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pa_csv
 from tqdm.auto import tqdm
 from pymed import PubMed
 import xmltodict
 import re
+import unicodedata
+from bisect import bisect_right
+from string import Formatter
+from xml.etree.ElementTree import tostring, fromstring, iterparse
+from datetime import date
 
 
 ids_exact = ['(?i)NCT\s*\W*0\d{7}', '20\d{2}\W*0\d{5}\W*\d{2}', '(?i)PACTR\s*\W*20\d{13}', '(?i)ACTRN\s*\W*126\d{11}', 
@@ -35,15 +49,71 @@ registry_names = ['(?i)clinicaltrials.gov', '(?i)European Union Clinical Trials
                   '(?i)Sri Lanka Clinical Trials Registry', '(?i)Thai Clinical Trials Registry',
                   '(?i)Peruvian Clinical Trial Registry']
 
+#The registry each pattern above belongs to, in the same order
+ids_exact_registries = ['NCT', 'EudraCT', 'PACTR', 'ACTRN', 'ANZCTR', 'NTR', 'KCT', 'DRKS', 'ISRCTN', 'ChiCTR', 
+                        'IRCT', 'CTRI', 'JapicCTI', 'jRCT', 'UMIN', 'JMA', 'RBR', 'RPCEC', 'LBCTR', 'SLCTR', 'TCTR', 
+                        'PER']
+
+prefix_registries = ['NCT', 'EudraCT', 'EUCTR', 'PACTR', 'ACTRN', 'ANZCTR', 'NTR', 'KCT', 'DRKS', 'ISRCTN', 'ChiCTR', 
+                     'IRCT', 'CTRI', 'JapicCTI', 'jRCT', 'UMIN', 'RBR', 'RPCEC', 'LBCTR', 'SLCTR', 'TCTR']
+
+registry_name_registries = ['NCT', 'EUCTR', 'PACTR', 'ANZCTR', 'NTR', 'KCT', 'DRKS', 'ChiCTR', 'IRCT', 'CTRI', 
+                            'JapicCTI', 'jRCT', 'UMIN', 'RBR', 'RPCEC', 'LBCTR', 'SLCTR', 'TCTR', 'PER']
+
 #From https://osf.io/xczyn/
 query = 'coronavirus*[ti] OR corona virus*[ti] OR covid*[ti] OR sars[ti] OR severe acute respiratory syndrome[ti] OR ncov*[ti] OR "severe acute respiratory syndrome coronavirus 2" [Supplementary Concept] OR "COVID-19" [Supplementary Concept] OR (wuhan[tiab] AND (coronavirus[tiab]OR coronavirus[tiab]OR pneumonia virus[tiab])) OR COVID19[tiab] OR COVID-19[tiab] OR coronavirus-2019[tiab] OR corona-virus-2019[tiab] OR SARS-CoV-2[tiab] OR SARSCoV-2[tiab] OR SARSCoV2[tiab] OR SARS2[tiab] OR SARS-2[tiab] OR "severe acute respiratory syndrome 2"[tiab] OR 2019-nCoV[tiab] OR ((novel coronavirus[tiab]OR novel corona virus[tiab])AND 2019[tiab])NOT (animals[mesh] NOT humans[mesh])AND ("2019/12/01"[EDAT] : "3000/12/31"[EDAT])'
 
-def zip_load(path, file, index_col=None, low_memory=True):
-      zip_file = ZipFile(path)
-      return read_csv(zip_file.open(file), index_col=index_col, low_memory=low_memory)
+def zip_chunks(path, file, usecols=None, dtype=None, predicate=None, chunksize=100000, low_memory=True):
+      #Streams one member of the zip in chunks, keeping only the columns asked for and the rows the predicate 
+      #(a function from a chunk to a boolean mask) lets through
+      with ZipFile(path) as zip_file:
+            with zip_file.open(file) as member:
+                  for chunk in read_csv(member, usecols=usecols, dtype=dtype, chunksize=chunksize, 
+                                        low_memory=low_memory):
+                        yield chunk[predicate(chunk)] if predicate is not None else chunk
+
+def arrow_type(t):
+      if t in (str, object, 'str', 'object'):
+            return pa.string()
+      else:
+            return pa.from_numpy_dtype(np.dtype(t))
+
+def zip_load(path, file, index_col=None, low_memory=True, usecols=None, dtype=None, predicate=None, chunksize=None, 
+             engine=None):
+      #engine='pyarrow' parses the member on multiple threads with only the usecols converted. Otherwise, 
+      #with a predicate or chunksize the member is read in chunks and only the matching rows are kept.
+      if engine == 'pyarrow':
+            #Empty strings are read as missing, as read_csv does
+            convert_options = pa_csv.ConvertOptions(
+                  include_columns=usecols, column_types={c: arrow_type(t) for c, t in (dtype or {}).items()}, 
+                  strings_can_be_null=True)
+            with ZipFile(path) as zip_file:
+                  with zip_file.open(file) as member:
+                        df = pa_csv.read_csv(member, convert_options=convert_options).to_pandas()
+            if predicate is not None:
+                  df = df[predicate(df)].reset_index(drop=True)
+            if index_col is not None:
+                  df = df.set_index(df.columns[index_col] if isinstance(index_col, int) else index_col)
+            return df
+      elif predicate is not None or chunksize is not None:
+            df = concat(zip_chunks(path, file, usecols, dtype, predicate, chunksize or 100000, low_memory), 
+                        ignore_index=True)
+            if index_col is not None:
+                  df = df.set_index(df.columns[index_col] if isinstance(index_col, int) else index_col)
+            return df
+      else:
+            with ZipFile(path) as zip_file:
+                  return read_csv(zip_file.open(file), index_col=index_col, low_memory=low_memory, usecols=usecols, 
+                                  dtype=dtype)
 
 
-def create_pubmed_archive(results_list):
+def create_pubmed_archive(results_list, archive_path=None):
+      #With an archive_path the articles are written to a columnar archive (see PubmedArchiveWriter) instead 
+      #of a frame with each record as JSON
+      if archive_path is not None:
+            with PubmedArchiveWriter(archive_path) as writer:
+                  writer.write([archive_record(r.xml) for r in tqdm(results_list) if hasattr(r, 'xml')])
+            return read_pubmed_archive(archive_path)
       archive = []
       for r in tqdm(results_list):
             pm_dict = r.toDict()
@@ -55,6 +125,121 @@ def create_pubmed_archive(results_list):
             archive.append(pm_dict)
       return DataFrame(archive)
 
+pubmed_fields = ['pmid', 'doi', 'accession', 'abstract', 'pub_types', 'edat', 'date_revised']
+
+def pubmed_date(elem):
+      #PubMed dates are split into Year/Month/Day elements
+      if elem is None:
+            return None
+      return date(int(elem.findtext('Year')), int(elem.findtext('Month') or 1), int(elem.findtext('Day') or 1))
+
+def pubmed_article_fields(article):
+      #The fields we need from one PubmedArticle element
+      doi = None
+      for x in article.iterfind('PubmedData/ArticleIdList/ArticleId'):
+            if x.get('IdType') == 'doi':
+                  doi = x.text
+      accession = [x.text for x in article.iterfind(
+            'MedlineCitation/Article/DataBankList/DataBank/AccessionNumberList/AccessionNumber')]
+      abstract = [''.join(x.itertext()) for x in article.iterfind('MedlineCitation/Article/Abstract/AbstractText')]
+      pub_types = [x.text for x in article.iterfind('MedlineCitation/Article/PublicationTypeList/PublicationType')]
+      return {'pmid': article.findtext('MedlineCitation/PMID'), 
+              'doi': doi, 
+              'accession': accession if accession else None, 
+              'abstract': ' '.join(abstract) if abstract else None, 
+              'pub_types': pub_types if pub_types else None, 
+              'edat': pubmed_date(article.find("PubmedData/History/PubMedPubDate[@PubStatus='entrez']")), 
+              'date_revised': pubmed_date(article.find('MedlineCitation/DateRevised'))}
+
+def archive_record(article):
+      #The extracted fields plus the article's raw XML, compressed
+      record = pubmed_article_fields(article)
+      record['xml'] = zlib.compress(tostring(article))
+      return record
+
+def iter_pubmed_xml(source, keep_xml=False):
+      #Streams the articles in a PubMed XML file, clearing each one once it has been read so memory stays flat 
+      #however many records there are
+      root = None
+      for event, elem in iterparse(source, events=('start', 'end')):
+            if root is None:
+                  root = elem
+            if event == 'end' and elem.tag == 'PubmedArticle':
+                  yield archive_record(elem) if keep_xml else pubmed_article_fields(elem)
+                  root.clear()
+
+#The columnar archive is a Parquet file with the extracted fields in their own columns and each article's raw 
+#XML zlib compressed in the xml column, so readers only load (and memory map) the columns they need
+pubmed_archive_schema = pa.schema([('pmid', pa.string()), ('doi', pa.string()), ('accession', pa.list_(pa.string())), 
+                                   ('abstract', pa.string()), ('pub_types', pa.list_(pa.string())), 
+                                   ('edat', pa.date32()), ('date_revised', pa.date32()), ('xml', pa.binary())])
+
+class PubmedArchiveWriter:
+      #Writes batches of archive records as they arrive, one row group per batch
+      def __init__(self, archive_path):
+            self.writer = pq.ParquetWriter(archive_path, pubmed_archive_schema)
+            self.rows = 0
+      
+      def write(self, records):
+            if not records:
+                  return
+            columns = {name: [r[name] for r in records] for name in pubmed_archive_schema.names}
+            self.writer.write_table(pa.Table.from_pydict(columns, schema=pubmed_archive_schema))
+            self.rows += len(records)
+      
+      def close(self):
+            self.writer.close()
+      
+      def __enter__(self):
+            return self
+      
+      def __exit__(self, *exc):
+            self.close()
+
+def convert_pubmed_archive(path, file, archive_path, chunksize=10000):
+      #Converts an archive made by create_pubmed_archive (each record's XML as JSON in the xml_json column of a 
+      #zipped CSV) to the columnar archive, so the same snapshot can be read without searching again. Returns 
+      #the number of articles.
+      with PubmedArchiveWriter(archive_path) as writer:
+            for chunk in zip_chunks(path, file, usecols=['xml_json'], chunksize=chunksize):
+                  writer.write([archive_record(fromstring(xmltodict.unparse(json.loads(rec), full_document=False)))
+                                for rec in chunk.xml_json])
+      return writer.rows
+
+def read_pubmed_archive(archive_path, columns=None):
+      df = pq.read_table(archive_path, columns=columns, memory_map=True).to_pandas()
+      #Parquet hands list columns back as arrays
+      for col in ['accession', 'pub_types']:
+            if col in df.columns:
+                  df[col] = df[col].map(lambda x: list(x) if x is not None else None)
+      return df
+
+def archive_xml(raw):
+      #The article element back from the archive's xml column
+      return fromstring(zlib.decompress(raw))
+
+def edat_query(start, end='3000/12/31', base_query=query):
+      #The search query limited to an EDAT window instead of everything since 2019/12/01
+      return re.sub(r'\("[\d/]+"\[EDAT\] : "[\d/]+"\[EDAT\]\)', f'("{start}"[EDAT] : "{end}"[EDAT])', base_query)
+
+def upsert_pubmed_archive(archive_path, updates_path):
+      #Merges newly fetched records into the archive keyed on PMID, the newest copy of a record winning. Returns 
+      #each fetched PMID with whether it was 'new', 'revised' (its XML changed) or 'unchanged'.
+      archive = read_pubmed_archive(archive_path)
+      updates = read_pubmed_archive(updates_path).drop_duplicates('pmid', keep='last')
+      previous = archive.set_index('pmid').xml
+      status = np.where(~updates.pmid.isin(previous.index), 'new', 
+                        np.where(updates.xml.values == updates.pmid.map(previous).values, 'unchanged', 'revised'))
+      merged = concat([archive[~archive.pmid.isin(updates.pmid)], updates], ignore_index=True)
+      merged = merged.astype(object).where(merged.notnull(), None)
+      tmp_path = archive_path + '.tmp'
+      with PubmedArchiveWriter(tmp_path) as writer:
+            records = merged.to_dict('records')
+            for i in range(0, len(records), 10000):
+                  writer.write(records[i:i + 10000])
+      os.replace(tmp_path, archive_path)
+      return DataFrame({'pmid': updates.pmid.values, 'status': status})
+
 def search_text(regex_list, to_search):
       hits = []
       for reg in regex_list:
@@ -77,6 +262,20 @@ def add_lists(grp):
     else:
         return np.nan
 
+def combine_lists(df, id_col, list_cols):
+    #Does the same as df.groupby(id_col)[list_cols].agg(add_lists) in one pass: every list column is exploded 
+    #into a long frame of (id, column, value), deduped and then grouped back into a list per id and column
+    long = []
+    for col in list_cols:
+        s = df[[id_col, col]][df[col].map(lambda x: isinstance(x, list))].explode(col)
+        s.columns = [id_col, 'value']
+        s['column'] = col
+        long.append(s)
+    long = concat(long, ignore_index=True).dropna().drop_duplicates()
+    combined = long.groupby([id_col, 'column'])['value'].agg(list).unstack('column')
+    ids = np.sort(df[id_col].dropna().unique())
+    return combined.reindex(index=ids, columns=list_cols).rename_axis(index=id_col, columns=None)
+
 def make_doi_url(x):
     if isinstance(x,str):
         return 'http://doi.org/' + x
@@ -94,3 +293,522 @@ def stringify(x):
             return str(x)
       else:
             return x
+
+def scope_flags(reg):
+    #A leading (?i) has to become a scoped (?i:...) group once the pattern is part of a larger alternation
+    if reg.startswith('(?i)'):
+        return '(?i:' + reg[4:] + ')'
+    else:
+        return '(?:' + reg + ')'
+
+#Characters that (?i) matches to an ASCII letter but that .lower() doesn't turn into one
+case_fold_extras = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u017f': 's', '\u212a': 'k'})
+
+#Folding puts each document into one form before any regex runs: NFKC normalised, case folded, dashes made 
+#hyphens and whitespace runs collapsed to one space. The patterns can then be case sensitive with plain \W* 
+#separators, and every folded position maps back to the original text for reporting hits.
+dash_variants = '\u2010\u2011\u2012\u2013\u2014\u2015\u2212\ufe58\ufe63\uff0d'
+fold_special = re.compile(r'\s{2,}|[^\S ]|[^\x00-\x7f]')
+
+def fold_char(ch):
+    if ch in dash_variants:
+        return '-'
+    return unicodedata.normalize('NFKC', ch.translate(case_fold_extras)).casefold()
+
+class FoldedText:
+    #ASCII runs are only lower cased so they map back one to one; everything else gets its own breakpoint 
+    #pointing at the original character (or the start of the whitespace run) it came from
+    def __init__(self, text):
+        self.text = text
+        self.folded_starts = []
+        self.original_starts = []
+        self.identity = []
+        pieces = []
+        pos = 0
+        last = 0
+        for m in fold_special.finditer(text):
+            if m.start() > last:
+                pos = self.add(pieces, pos, last, text[last:m.start()].lower(), True)
+            pos = self.add(pieces, pos, m.start(), ' ' if m.group()[0].isspace() else fold_char(m.group()), False)
+            last = m.end()
+        if last < len(text):
+            self.add(pieces, pos, last, text[last:].lower(), True)
+        self.folded = ''.join(pieces)
+    
+    def add(self, pieces, pos, original, piece, identity):
+        if piece:
+            pieces.append(piece)
+            self.folded_starts.append(pos)
+            self.original_starts.append(original)
+            self.identity.append(identity)
+        return pos + len(piece)
+    
+    def position(self, p):
+        if p >= len(self.folded):
+            return len(self.text)
+        i = bisect_right(self.folded_starts, p) - 1
+        return self.original_starts[i] + (p - self.folded_starts[i] if self.identity[i] else 0)
+    
+    def span(self, start, end):
+        #The original span a folded span came from
+        return self.position(start), self.position(end)
+
+def fold_pattern(reg):
+    #The case sensitive pattern for folded text: (?i) dropped, literals lower cased and the whitespace that 
+    #folding has already collapsed simplified
+    reg = re.sub(r'^\(\?i\)', '', reg)
+    reg = re.sub(r'\\s[*?]\\W\*', r'\\W*', reg)
+    reg = re.sub(r'\\s[*?]', ' ?', reg)
+    return re.sub(r'(?<!\\)[A-Z]', lambda m: m.group().lower(), reg)
+
+def prefilter_literal(reg):
+    #The literal text every match of a pattern has to start with and whether it is case insensitive. 
+    #Case insensitive literals are lower cased.
+    ignore_case = reg.startswith('(?i)')
+    stripped = re.sub(r'^(\(\?i\)|\{\?i\})', '', reg).replace('\\b', '')
+    literal = re.match(r'[A-Za-z0-9 \-]+', stripped)
+    literal = literal.group() if literal else ''
+    #A quantifier that allows none of the last character (like the ' ?' in a folded 'japic ?cti') means that
+    #character isn't always there
+    if re.match(r'[?*]|\{0?,', stripped[len(literal):]):
+        literal = literal[:-1]
+    if not literal:
+        raise ValueError(f'No literal prefix to prefilter on in {reg}')
+    return (literal.lower(), True) if ignore_case else (literal, False)
+
+class RegistryMatcher:
+    #Compiles each pattern list once into a single alternation with a named group per pattern so every 
+    #document is scanned once per list rather than once per pattern. Where two patterns in the same list 
+    #match overlapping text only the leftmost (then first listed) match is reported.
+    #Before any regex runs, the lower cased document is checked for the literal each pattern starts with. 
+    #Patterns whose literal is missing can't match so they are left out of the alternation, and lists with 
+    #no literal present at all are skipped. The counters show how much work this saved.
+    #Each list also gets a version hash so cached results can be tied to the patterns that produced them.
+    #With folded=True each document is folded (see FoldedText) and the simplified case sensitive patterns run 
+    #against that, with the hits mapped back to the original text.
+    def __init__(self, pattern_lists=None, folded=False):
+        if pattern_lists is None:
+            pattern_lists = {'id_hits': (ids_exact, ids_exact_registries), 
+                             'prefix_hits': (prefixes, prefix_registries), 
+                             'reg_name_hits': (registry_names, registry_name_registries)}
+        if folded:
+            pattern_lists = {kind: ([fold_pattern(reg) for reg in regex_list], registries) 
+                             for kind, (regex_list, registries) in pattern_lists.items()}
+        self.pattern_lists = pattern_lists
+        self.folded = folded
+        self.literals = {}
+        self.registries = {}
+        self.compiled = {}
+        self.versions = {}
+        for kind, (regex_list, registries) in pattern_lists.items():
+            self.literals[kind] = [prefilter_literal(reg) for reg in regex_list]
+            self.registries[kind] = {f'{kind}_{i}': r for i, r in enumerate(registries)}
+            #The literals are part of the version since which patterns run depends on them too
+            self.versions[kind] = hashlib.sha1(json.dumps([list(regex_list), list(registries), 
+                                                           self.literals[kind]]).encode()).hexdigest()
+        self.counters = {'documents': 0, 'skipped_documents': 0}
+        for kind in pattern_lists:
+            self.counters[kind + '_scanned'] = 0
+            self.counters[kind + '_skipped'] = 0
+    
+    def alternation(self, kind, live):
+        #Compiled once for each combination of live patterns that comes up
+        key = (kind, live)
+        if key not in self.compiled:
+            regex_list = self.pattern_lists[kind][0]
+            groups = [f'(?P<{kind}_{i}>{scope_flags(regex_list[i])})' for i in live]
+            self.compiled[key] = re.compile('|'.join(groups))
+        return self.compiled[key]
+    
+    def prefilter(self, to_search, kinds):
+        #The patterns in each list whose literal appears in the document
+        lowered = to_search if self.folded else to_search.translate(case_fold_extras).lower()
+        return {kind: tuple(i for i, (lit, ignore_case) in enumerate(self.literals[kind]) 
+                            if lit in (lowered if ignore_case else to_search)) 
+                for kind in kinds}
+    
+    def scan(self, to_search, kinds=None):
+        #Returns (kind, registry, hit, offset) for every hit in the document, optionally for only some of the 
+        #pattern lists
+        hits = []
+        if not to_search:
+            return hits
+        self.counters['documents'] += 1
+        text = FoldedText(to_search) if self.folded else None
+        if text is not None:
+            to_search = text.folded
+        live = self.prefilter(to_search, kinds or list(self.pattern_lists))
+        if not any(live.values()):
+            self.counters['skipped_documents'] += 1
+        for kind, patterns in live.items():
+            if not patterns:
+                self.counters[kind + '_skipped'] += 1
+                continue
+            self.counters[kind + '_scanned'] += 1
+            for m in self.alternation(kind, patterns).finditer(to_search):
+                if text is None:
+                    hits.append((kind, self.registries[kind][m.lastgroup], m.group(), m.start()))
+                else:
+                    start, end = text.span(m.start(), m.end())
+                    hits.append((kind, self.registries[kind][m.lastgroup], text.text[start:end], start))
+        return hits
+    
+    def group(self, scanned, kinds=None):
+        #Same shape as search_text: a list of hits per kind, or None when there are none
+        found = {kind: [] for kind in (kinds or self.pattern_lists)}
+        for kind, _, hit, _ in scanned:
+            found[kind].append(hit)
+        return {kind: (hits if hits else None) for kind, hits in found.items()}
+    
+    def search(self, to_search, kinds=None):
+        return self.group(self.scan(to_search, kinds), kinds)
+
+#Columns of a PubMed scan, as in notebook 2
+pubmed_scan_cols = ['pmid', 'hit_sections', 'abst_id_hits', 'reg_prefix_hits', 'reg_name_hits', 'versions']
+
+def scan_pubmed_abstracts(records, matcher, previous=None, rescan=()):
+    #Scans the abstracts of the given records (pmid and abstract columns). With the results of an earlier scan, 
+    #only records that are new, listed in rescan or were scanned with different patterns are scanned again.
+    versions = json.dumps(matcher.versions, sort_keys=True)
+    if previous is not None:
+        previous = previous[(previous.versions == versions) & ~previous.pmid.isin(rescan) & 
+                            previous.pmid.isin(records.pmid)]
+        to_scan = records[~records.pmid.isin(previous.pmid)]
+    else:
+        to_scan = records
+    rows = []
+    for pmid, abstract in tqdm(zip(to_scan.pmid, to_scan.abstract), total=len(to_scan)):
+        scanned = matcher.scan(abstract)
+        hits = matcher.group(scanned)
+        rows.append((pmid, [(kind, 'abstract', hit, offset) for kind, _, hit, offset in scanned] or None, 
+                     hits['id_hits'], hits['prefix_hits'], hits['reg_name_hits'], versions))
+    scans = DataFrame(rows, columns=pubmed_scan_cols)
+    if previous is not None:
+        scans = concat([previous, scans], ignore_index=True)
+    return scans
+
+#The parts of a CORD-19 parse that hold the paper's text. back_matter and bib_entries (reference titles and 
+#venues) can be left out to scan less.
+cord_sections = ('title', 'abstract', 'body_text', 'back_matter', 'bib_entries')
+
+def plan_cord_parses(metadata, pdf_files, pmc_files):
+    #Picks one parse to scan for each cord_uid: its PMC parse if there is one, otherwise the parse of the first 
+    #sha listed (metadata joins several shas with ';'). Papers can share a parse, in which case it is in the plan 
+    #once for each of them but only scanned once. Returns the plan (cord_uid, source, parse_id, file_name) and 
+    #how many parses this avoids scanning.
+    pmc = metadata[['cord_uid', 'pmcid']].dropna()
+    pmc = DataFrame({'cord_uid': pmc.cord_uid, 'source': 'cord_pmc', 'parse_id': pmc.pmcid, 'rank': 0})
+    pdf = metadata[['cord_uid', 'sha']].dropna()
+    pdf = pdf.assign(sha=pdf.sha.str.split(';')).explode('sha')
+    pdf = DataFrame({'cord_uid': pdf.cord_uid, 'source': 'cord_pdf', 'parse_id': pdf.sha.str.strip(), 
+                     'rank': 1 + pdf.groupby(level=0).cumcount()})
+    candidates = concat([pmc, pdf]).reset_index().rename(columns={'index': 'row'})
+    candidates['file_name'] = candidates.parse_id + np.where(candidates.source == 'cord_pmc', '.xml.json', '.json')
+    available = np.where(candidates.source == 'cord_pmc', candidates.file_name.isin(set(pmc_files)), 
+                         candidates.file_name.isin(set(pdf_files)))
+    candidates = candidates[available]
+    #Each paper's choice is made before any parse is deduplicated, so sharing a parse never leaves a paper out
+    plan = candidates.sort_values(['rank', 'row'], kind='mergesort').drop_duplicates('cord_uid')
+    plan = plan.sort_values('row', kind='mergesort')[['cord_uid', 'source', 'parse_id', 'file_name']]
+    available_parses = candidates.drop_duplicates(['source', 'file_name'])
+    scanned = plan.drop_duplicates(['source', 'file_name'])
+    report = {'cord_uids': len(plan), 
+              'parses_available': len(available_parses), 
+              'parses_scanned': len(scanned), 
+              'duplicate_parses_skipped': len(available_parses) - len(scanned), 
+              'pmc_scanned': int((scanned.source == 'cord_pmc').sum()), 
+              'pdf_scanned': int((scanned.source == 'cord_pdf').sum())}
+    return plan.reset_index(drop=True), report
+
+def cord_section_texts(doc, sections):
+    for section in sections:
+        if section == 'title':
+            texts = [doc.get('metadata', {}).get('title')]
+        elif section == 'bib_entries':
+            texts = [e.get(field) for e in doc.get('bib_entries', {}).values() for field in ['title', 'venue']]
+        else:
+            texts = [p.get('text') for p in doc.get(section) or []]
+        yield section, '\n'.join(t for t in texts if t)
+
+#Record columns for each pattern list
+hit_cols = {'id_hits': 'id_hits', 'prefix_hits': 'reg_prefix_hits', 'reg_name_hits': 'reg_name_hits'}
+
+def scan_cord_text(c_text, source, matcher, sections=None, kinds=None):
+    #With no sections the whole file is scanned, JSON and all. Otherwise only the text of the given 
+    #sections is scanned and every hit is recorded against the section it came from, as 
+    #(kind, section, hit, offset into the section text).
+    kinds = kinds or list(matcher.pattern_lists)
+    doc = json.loads(c_text)
+    record = {'file_name': doc['paper_id'], 'source': source}
+    if sections is None:
+        hits = matcher.search(c_text, kinds)
+    else:
+        hits = {kind: [] for kind in kinds}
+        hit_sections = []
+        for section, text in cord_section_texts(doc, sections):
+            for kind, _, hit, offset in matcher.scan(text, kinds):
+                hits[kind].append(hit)
+                hit_sections.append((kind, section, hit, offset))
+        hits = {kind: (h if h else None) for kind, h in hits.items()}
+        record['hit_sections'] = hit_sections if hit_sections else None
+    for kind in kinds:
+        record[hit_cols[kind]] = hits[kind]
+    return record
+
+#Scan results are cached by (file content hash, sections scanned, pattern list, pattern list version) so a 
+#rerun over a new CORD-19 release only scans parses that are new or have changed, and editing one pattern 
+#list only invalidates the results for that list
+def open_scan_cache(cache_path):
+    conn = sqlite3.connect(cache_path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS scan_cache (content_hash TEXT, sections TEXT, kind TEXT, '
+                 'version TEXT, result TEXT, PRIMARY KEY (content_hash, sections, kind, version))')
+    return conn
+
+def cached_scans(conn, content_hash, sections_key, versions):
+    rows = conn.execute('SELECT kind, version, result FROM scan_cache WHERE content_hash = ? AND sections = ?', 
+                        (content_hash, sections_key)).fetchall()
+    return {kind: json.loads(result) for kind, version, result in rows if versions.get(kind) == version}
+
+def scan_cord_file(path, source, matcher, sections=None, cache=None):
+    #Scans one parse, reusing whatever results the cache already holds for its contents. Returns the 
+    #record and the new cache rows.
+    with open(path, 'rb') as x:
+        raw = x.read()
+    if cache is None:
+        return scan_cord_text(raw.decode('utf-8'), source, matcher, sections), []
+    
+    content_hash = hashlib.sha1(raw).hexdigest()
+    sections_key = ','.join(sections) if sections is not None else 'raw'
+    results = cached_scans(cache, content_hash, sections_key, matcher.versions)
+    missing = [kind for kind in matcher.pattern_lists if kind not in results]
+    new_rows = []
+    if missing:
+        scanned = scan_cord_text(raw.decode('utf-8'), source, matcher, sections, missing)
+        for kind in missing:
+            results[kind] = {'paper_id': scanned['file_name'], 'hits': scanned[hit_cols[kind]], 
+                             'hit_sections': [h for h in scanned.get('hit_sections') or [] if h[0] == kind]}
+            new_rows.append((content_hash, sections_key, kind, matcher.versions[kind], json.dumps(results[kind])))
+    
+    record = {'file_name': next(iter(results.values()))['paper_id'], 'source': source}
+    if sections is not None:
+        #In the order a fresh scan reports them: by section, then pattern list
+        hit_sections = sorted([tuple(h) for kind in matcher.pattern_lists for h in results[kind]['hit_sections']], 
+                              key=lambda h: (sections.index(h[1]), list(matcher.pattern_lists).index(h[0])))
+        record['hit_sections'] = hit_sections if hit_sections else None
+    for kind in matcher.pattern_lists:
+        record[hit_cols[kind]] = results[kind]['hits']
+    return record, new_rows
+
+#Each worker process builds its own matcher once
+worker_matcher = None
+
+def init_scan_worker(folded=False):
+    global worker_matcher
+    worker_matcher = RegistryMatcher(folded=folded)
+
+def scan_cord_batch(batch):
+    folder, files, source, sections, cache_path = batch
+    worker_matcher.counters = {k: 0 for k in worker_matcher.counters}
+    cache = sqlite3.connect(cache_path, timeout=60) if cache_path else None
+    records = []
+    new_rows = []
+    for f in files:
+        record, rows = scan_cord_file(os.path.join(folder, f), source, worker_matcher, sections, cache)
+        records.append(record)
+        new_rows += rows
+    if cache is not None:
+        cache.close()
+    return records, new_rows, worker_matcher.counters
+
+def scan_cord_files(folder, files, source, sections=None, cache_path=None, folded=False, workers=None, batch_size=200):
+    #Scans CORD-19 document parses across a pool of processes, handing out the files in batches. Returns
+    #the same records as the serial loop in notebook 2 along with the summed prefilter counters.
+    #With a cache_path, results are read from and saved to the scan cache. folded is passed to RegistryMatcher.
+    cache = open_scan_cache(cache_path) if cache_path else None
+    batches = [(folder, files[i:i + batch_size], source, sections, cache_path) 
+               for i in range(0, len(files), batch_size)]
+    records = []
+    counters = {'cached_results': 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_scan_worker, initargs=(folded,)) as executor:
+        for batch_records, new_rows, batch_counters in tqdm(executor.map(scan_cord_batch, batches), 
+                                                            total=len(batches)):
+            records += batch_records
+            for k, v in batch_counters.items():
+                counters[k] = counters.get(k, 0) + v
+            if cache is not None:
+                counters['cached_results'] += len(batch_records) * len(hit_cols) - len(new_rows)
+                cache.executemany('INSERT OR REPLACE INTO scan_cache VALUES (?, ?, ?, ?, ?)', new_rows)
+                cache.commit()
+    if cache is not None:
+        cache.close()
+    return records, counters
+
+#How an ids_exact hit in any of its surface forms maps to the TrialID the ICTRP uses. Each pattern is anchored and 
+#lets any run of separators through; the template rebuilds the ID from the named groups, with :upper/:lower 
+#setting their case.
+sep = r'[\W_]*'
+trial_id_forms = [
+    ('NCT', rf'(?i)^NCT{sep}(?P<n>0\d{{7}})$', 'NCT{n}'),
+    ('EUCTR', rf'(?i)^(?:EUCTR|EudraCT)?{sep}(?P<y>20\d{{2}}){sep}(?P<n>0\d{{5}}){sep}(?P<c>\d{{2}})$', 'EUCTR{y}-{n}-{c}'),
+    ('EUCTR', rf'(?i)^(?:EUCTR|EudraCT)?{sep}(?P<y>20\d{{2}}){sep}(?P<n>0\d{{5}}){sep}(?P<c>\d{{2}}){sep}(?P<s>[A-Z]{{2}}|3RD)$', 
+     'EUCTR{y}-{n}-{c}-{s:upper}'),
+    ('PACTR', rf'(?i)^PACTR{sep}(?P<n>20\d{{13}})$', 'PACTR{n}'),
+    ('ACTRN', rf'(?i)^(?:ACTRN|ANZCTR){sep}(?P<n>126\d{{11}})$', 'ACTRN{n}'),
+    ('NTR', rf'(?i)^NTR{sep}(?P<n>\d{{4}})$', 'NTR{n}'),
+    ('NL', rf'(?i)^NL{sep}(?P<n>\d{{4,5}})$', 'NL{n}'),
+    ('KCT', rf'(?i)^KCT{sep}(?P<n>00\d{{5}})$', 'KCT{n}'),
+    ('DRKS', rf'(?i)^DRKS{sep}(?P<n>000\d{{5}})$', 'DRKS{n}'),
+    ('ISRCTN', rf'(?i)^ISRCTN{sep}(?P<n>\d{{8}})$', 'ISRCTN{n}'),
+    ('ChiCTR', rf'(?i)^ChiCTR{sep}(?P<n>20000\d{{5}})$', 'ChiCTR{n}'),
+    ('IRCT', rf'(?i)^IRCT{sep}(?P<n>20\d{{10,12}})N(?P<v>\d{{1,3}})$', 'IRCT{n}N{v}'),
+    ('CTRI', rf'(?i)^CTRI{sep}(?P<y>202\d){sep}(?P<m>\d{{2,3}}){sep}(?P<n>0\d{{5}})$', 'CTRI/{y}/{m}/{n}'),
+    ('JapicCTI', rf'(?i)^(?:JPRN{sep})?Japic{sep}CTI{sep}(?P<n>\d{{6}})$', 'JPRN-JapicCTI-{n}'),
+    ('jRCT', rf'(?i)^(?:JPRN{sep})?jRCT{sep}(?P<t>\w){sep}(?P<n>\d{{9}})$', 'JPRN-jRCT{t:lower}{n}'),
+    ('UMIN', rf'(?i)^(?:JPRN{sep})?UMIN{sep}(?P<n>\d{{9}})$', 'JPRN-UMIN{n}'),
+    ('JMA', rf'(?i)^(?:JPRN{sep})?JMA{sep}IIA(?P<n>00\d{{3}})$', 'JPRN-JMA-IIA{n}'),
+    ('RBR', rf'(?i)^RBR{sep}(?P<n>\d\w{{5}})$', 'RBR-{n:lower}'),
+    ('RPCEC', rf'(?i)^RPCEC{sep}(?P<n>0{{5}}\d{{3}})$', 'RPCEC{n}'),
+    ('LBCTR', rf'(?i)^LBCTR{sep}(?P<n>\d{{10}})$', 'LBCTR{n}'),
+    ('SLCTR', rf'(?i)^SLCTR{sep}(?P<y>\d{{4}}){sep}(?P<n>\d{{3}})$', 'SLCTR/{y}/{n}'),
+    ('TCTR', rf'(?i)^TCTR{sep}(?P<n>202\d{{8}})$', 'TCTR{n}'),
+    ('PER', rf'(?i)^PER{sep}(?P<n>\d{{3}}){sep}(?P<y>\d{{2}})$', 'PER-{n}-{y}'),
+]
+
+def fill_template(template, parts):
+    #Builds the template column-wise from the extracted groups
+    built = Series('', index=parts.index)
+    for literal, field, spec, _ in Formatter().parse(template):
+        built = built + literal
+        if field is not None:
+            part = parts[field]
+            if spec == 'upper':
+                part = part.str.upper()
+            elif spec == 'lower':
+                part = part.str.lower()
+            built = built + part
+    return built
+
+def euctr_base(ids):
+    return ids.str.replace(r'^(EUCTR\d{4}-\d{6}-\d{2})-\w+$', r'\1', regex=True)
+
+def canonical_trial_ids(hits, known_ids=None):
+    #Maps each hit to the ICTRP TrialID form and, given the known TrialIDs, says whether it matched. EUCTR hits 
+    #without a country suffix take the suffix of the known ID for that EudraCT number. Statuses are 
+    #'unparsed', 'parsed' (no known IDs given), 'matched', 'suffix_resolved', 'suffix_ambiguous' (more than one 
+    #known country, the first is used) and 'not_in_ictrp'.
+    hits = Series(hits)
+    stripped = hits.astype(str).str.strip()
+    out = DataFrame({'hit': hits, 'trial_id': np.nan, 'registry': np.nan}, index=hits.index, dtype=object)
+    todo = hits.notnull()
+    for registry, pattern, template in trial_id_forms:
+        parts = stripped[todo].str.extract(pattern)
+        found = parts.notnull().any(axis=1)
+        if found.any():
+            parts = parts[found]
+            out.loc[parts.index, 'trial_id'] = fill_template(template, parts)
+            out.loc[parts.index, 'registry'] = registry
+            todo[parts.index] = False
+    parsed = out.trial_id.notnull()
+    if known_ids is None:
+        out['match_status'] = np.where(parsed, 'parsed', 'unparsed')
+        return out
+    
+    known = Series(sorted(set(Series(known_ids).dropna())))
+    out['match_status'] = np.where(out.trial_id.isin(known), 'matched', np.where(parsed, 'not_in_ictrp', 'unparsed'))
+    euctr = known[known.str.startswith('EUCTR')]
+    suffixed = DataFrame({'trial_id': euctr, 'base': euctr_base(euctr)})
+    suffixed = suffixed[suffixed.trial_id != suffixed.base]
+    n_suffixes = suffixed.base.value_counts()
+    first_suffix = suffixed.drop_duplicates('base').set_index('base').trial_id
+    bare = (out.match_status == 'not_in_ictrp') & (out.registry == 'EUCTR') & out.trial_id.isin(first_suffix.index)
+    out.loc[bare, 'match_status'] = np.where(out.trial_id[bare].map(n_suffixes) > 1, 'suffix_ambiguous', 'suffix_resolved')
+    out.loc[bare, 'trial_id'] = out.trial_id[bare].map(first_suffix)
+    return out
+
+#The trial ID/publication links are also written to a SQLite index with one row per hit so lookups don't 
+#need the whole results file loaded and its list columns parsed. Only ID hits have a trial_id; prefix and 
+#registry name hits are kept with a NULL one.
+hit_index_cols = ['trial_id', 'doc_id', 'source', 'hit_type', 'section', 'offset', 'hit', 'match_status']
+
+def index_trial_id(hit):
+    return re.sub(r'\s+', '', hit).upper()
+
+def index_trial_ids(hits, known_ids=None):
+    #The canonical form where the hit parses as a trial ID
+    canonical = canonical_trial_ids(Series(hits, dtype=object), known_ids)
+    return canonical.trial_id.fillna(canonical.hit.map(index_trial_id)), canonical.match_status
+
+def index_doc_id(x):
+    #Document IDs are PubMed IDs or cord_uids, which are read as text. Anything else means an ID column was 
+    #read with the wrong type.
+    if not isinstance(x, str):
+        raise TypeError(f'Document IDs should be strings, not {type(x).__name__} ({x!r})')
+    return x
+
+def hit_index_rows(results):
+    #Takes the combined search results from notebook 2. Hits with a section and offset come from 
+    #hit_sections; anything scanned without them only has the hit lists to go on.
+    rows = []
+    has_sections = 'hit_sections' in results.columns
+    for r in results.to_dict('records'):
+        doc_id = index_doc_id(r['id'])
+        hit_sections = r['hit_sections'] if has_sections else None
+        if isinstance(hit_sections, list):
+            for kind, section, hit, offset in hit_sections:
+                rows.append((None, doc_id, r['source'], kind, section, offset, hit))
+        else:
+            for kind in ['id_hits', 'prefix_hits', 'reg_name_hits']:
+                if isinstance(r.get(kind), list):
+                    for hit in r[kind]:
+                        rows.append((None, doc_id, r['source'], kind, None, None, hit))
+    return rows
+
+def build_hit_index(results, index_path, known_ids=None):
+    #Rebuilds the index from scratch and returns the number of rows written. ID hits are stored under their 
+    #canonical TrialID with the match status against known_ids (the ICTRP TrialIDs) so linking to the 
+    #ICTRP is a join. base_id is the TrialID without any EUCTR country suffix, which is what lookups match on.
+    rows = DataFrame(hit_index_rows(results), columns=hit_index_cols[:-1], dtype=object)
+    id_hits = rows.hit_type == 'id_hits'
+    trial_ids, match_status = index_trial_ids(rows.hit[id_hits], known_ids)
+    rows.loc[id_hits, 'trial_id'] = trial_ids
+    rows['match_status'] = match_status
+    rows['base_id'] = euctr_base(rows.trial_id[id_hits])
+    rows = rows.where(rows.notnull(), None)
+    conn = sqlite3.connect(index_path)
+    conn.execute('DROP TABLE IF EXISTS trial_hits')
+    conn.execute('CREATE TABLE trial_hits (trial_id TEXT, doc_id TEXT, source TEXT, hit_type TEXT, section TEXT, '
+                 'offset INTEGER, hit TEXT, match_status TEXT, base_id TEXT)')
+    conn.executemany('INSERT INTO trial_hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows.itertuples(index=False))
+    conn.execute('CREATE INDEX trial_hits_trial_id ON trial_hits (trial_id)')
+    conn.execute('CREATE INDEX trial_hits_base_id ON trial_hits (base_id)')
+    conn.execute('CREATE INDEX trial_hits_doc_id ON trial_hits (doc_id)')
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+def lookup_trial(index_path, trial_id):
+    #Every hit for one trial ID
+    return lookup_trials(index_path, [trial_id])
+
+def lookup_trials(index_path, trial_ids):
+    #Every hit for a batch of trial IDs, looked up through the index via a temporary table. EUCTR IDs are 
+    #matched on their EudraCT number, so hits stored with any country suffix (or none) are all found.
+    wanted = euctr_base(index_trial_ids(list(trial_ids))[0])
+    conn = sqlite3.connect(index_path)
+    conn.execute('CREATE TEMP TABLE wanted (base_id TEXT PRIMARY KEY)')
+    conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(t,) for t in wanted])
+    cur = conn.execute(f'SELECT {", ".join("h." + c for c in hit_index_cols)} FROM wanted w '
+                       'JOIN trial_hits h ON h.base_id = w.base_id ORDER BY h.trial_id, h.doc_id, h.offset')
+    found = DataFrame(cur.fetchall(), columns=hit_index_cols)
+    conn.close()
+    return found
+
+def lookup_doc(index_path, doc_id):
+    #Every hit in one document
+    conn = sqlite3.connect(index_path)
+    cur = conn.execute(f'SELECT {", ".join(hit_index_cols)} FROM trial_hits WHERE doc_id = ? ORDER BY offset', 
+                       (str(doc_id),))
+    found = DataFrame(cur.fetchall(), columns=hit_index_cols)
+    conn.close()
+    return found
@@ -0,0 +1,142 @@
+import os
+import json
+import ast
+import pandas as pd
+
+#Every stage output is written as the usual CSV plus a typed Parquet copy next to it so later notebooks don't
+#have to re-parse dates or split list-valued columns. The schemas say which columns get which type. 'lists' are 
+#'; ' separated text in the CSV; 'json' columns, where a missing list has to stay missing or the lists hold 
+#tuples, are JSON text in both files.
+ictrp_schema = {'dates': ['date_registration', 'date_enrollement'],
+                'categories': ['source_register', 'phase', 'recruitment_status', 'study_type'],
+                'lists': ['intervention_list', 'cross_registrations'],
+                'integers': ['target_enrollment'],
+                'json': []}
+
+search_results_schema = {'dates': [], 'categories': ['source'], 'lists': [], 'integers': [], 
+                         'json': ['id_hits', 'prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 
+                                  'hit_sections']}
+
+stage_schemas = {
+    'ictrp_rows': {'dates': ['Date_registration', 'Date_enrollement'],
+                   'categories': ['Source_Register', 'Phase', 'Recruitment_Status', 'Study_type'],
+                   'lists': [],
+                   'integers': ['target_enrollment'],
+                   'json': []},
+    'cleaned_ictrp': ictrp_schema,
+    'ictrp_with_exclusions': ictrp_schema,
+    'registry_data_clean': {'dates': ['pcd', 'scd', 'relevant_comp_date'],
+                            'categories': ['trial_status'],
+                            'lists': [],
+                            'integers': [],
+                            'json': []},
+    'final_dataset': {'dates': ictrp_schema['dates'] + ['pcd', 'scd', 'relevant_comp_date'],
+                      'categories': ictrp_schema['categories'],
+                      'lists': ictrp_schema['lists'],
+                      'integers': ictrp_schema['integers'],
+                      'json': []},
+    'pubmed_search_results': search_results_schema,
+    'cord_19_search_results': search_results_schema,
+    'final_auto': {'dates': [], 'categories': [], 'lists': [], 'integers': [], 
+                   'json': ['id_hits', 'prefix_hits', 'reg_name_hits', 'accession']}
+}
+
+def parquet_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+def split_list(x):
+    if isinstance(x, list):
+        return x
+    elif isinstance(x, str) and x != 'None':
+        return [v.strip() for v in x.split(';') if v.strip()]
+    else:
+        return []
+
+def join_list(x):
+    if isinstance(x, list):
+        return '; '.join(x) if x else 'None'
+    else:
+        return x
+
+def to_json(x):
+    return json.dumps(x) if isinstance(x, (list, tuple)) else x
+
+def from_json(x):
+    #Lists of lists come back as lists of tuples. CSVs written before these stages were typed have Python reprs.
+    if not isinstance(x, str):
+        return x
+    try:
+        values = json.loads(x)
+    except ValueError:
+        values = ast.literal_eval(x)
+    if not isinstance(values, list):
+        return values
+    return [tuple(v) if isinstance(v, list) else v for v in values]
+
+def to_integers(s):
+    #A nullable integer column. Text that isn't a number (like the 'Not Available' older CSVs have) is missing, 
+    #but a number that isn't whole is an error rather than being rounded.
+    values = pd.to_numeric(s, errors='coerce')
+    bad = s[values.notnull() & (values % 1 != 0)]
+    if len(bad) > 0:
+        raise ValueError(f'{s.name} should only hold whole numbers but has {list(bad.unique()[:5])}')
+    return values.astype('Int64')
+
+def to_typed(df, schema):
+    df = df.copy()
+    for col in schema['dates']:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    for col in schema['categories']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in schema['lists']:
+        if col in df.columns:
+            df[col] = df[col].map(split_list)
+    for col in schema['integers']:
+        if col in df.columns:
+            df[col] = to_integers(df[col])
+    for col in schema['json']:
+        if col in df.columns:
+            df[col] = df[col].map(from_json)
+    return df
+
+def to_text(df, schema):
+    #The CSV keeps list columns in their original '; ' separated form
+    df = df.copy()
+    for col in schema['lists']:
+        if col in df.columns:
+            df[col] = df[col].map(join_list)
+    for col in schema['json']:
+        if col in df.columns:
+            df[col] = df[col].map(to_json)
+    return df
+
+def write_stage(df, csv_path, schema, index=True):
+    to_text(df, schema).to_csv(csv_path, index=index)
+    typed = to_typed(df, schema)
+    for col in schema['json']:
+        if col in typed.columns:
+            typed[col] = typed[col].map(to_json)
+    typed.to_parquet(parquet_path(csv_path), index=index)
+
+def read_stage(csv_path, schema, **kwargs):
+    #Prefers the typed Parquet copy and falls back to the CSV, typed the same way. A CSV that was edited after
+    #the Parquet copy was written wins, since the copy is out of date.
+    try:
+        if os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(parquet_path(csv_path)):
+            raise FileNotFoundError('The Parquet copy is older than the CSV')
+        df = pd.read_parquet(parquet_path(csv_path))
+    except (FileNotFoundError, OSError, ImportError):
+        #Stages written with their index have it in an unnamed first column, which the Parquet copy restores
+        if 'index_col' not in kwargs and pd.read_csv(csv_path, nrows=0).columns[0] == 'Unnamed: 0':
+            kwargs['index_col'] = 0
+        return to_typed(pd.read_csv(csv_path, **kwargs), schema)
+    #Parquet hands list columns back as arrays
+    for col in schema['lists']:
+        if col in df.columns:
+            df[col] = df[col].map(list)
+    for col in schema['json']:
+        if col in df.columns:
+            df[col] = df[col].map(from_json)
+    return df
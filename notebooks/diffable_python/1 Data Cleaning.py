@@ -35,49 +35,48 @@ from datetime import date
 
 df = pd.read_csv(parent + '/data/ictrp_data/COVID19-web_29June2020.csv', dtype={'Phase': str})
 
-# +
-from lib.data_cleaning import enrollment_dates, fix_date, fix_errors, d_c
-
-#This is fixes for known broken enrollement dates    
-known_errors= {
-    'IRCT20200310046736N1': ['2641-06-14', '2020-04-01'],
-    'EUCTR2020-001909-22-FR': ['nan', '2020-04-29']
-}
-# -
-
-df = fix_errors(known_errors, df)
+# The COVID-19 export is small enough to load in one go. For the full ICTRP export use `lib.data_cleaning.stream_clean_ictrp`, which reads only the columns we need in fixed-size chunks and writes the cleaned trials out as it goes.
 
 # +
-df['Date enrollement'] = df['Date enrollement'].apply(enrollment_dates)
-
-df['Date registration'] = pd.to_datetime(df['Date registration3'], format='%Y%m%d')
+from lib.data_cleaning import fix_date, apply_corrections, correction_cols, d_c
 
-# +
-from lib.data_cleaning import enroll_extract
-
-#Extracting target enrollment
-size = df['Target size'].tolist()
-
-df['target_enrollment'] = enroll_extract(size)
+#This is fixes for known broken values. Any column can be corrected.
+known_errors = pd.DataFrame([
+    ['IRCT20200310046736N1', 'Date enrollement', '2641-06-14', '2020-04-01'],
+    ['EUCTR2020-001909-22-FR', 'Date enrollement', 'nan', '2020-04-29']
+], columns=correction_cols)
+# -
 
-#Creating retrospective registration
-df['retrospective_registration'] = np.where(df['Date registration'] > df['Date enrollement'], True, False)
+df, correction_report = apply_corrections(df, known_errors)
+correction_report
 
 # +
-#Taking only what we need right now
-
-cols = ['TrialID', 'Source Register', 'Date registration', 'Date enrollement', 'retrospective_registration', 
-        'Primary sponsor', 'Recruitment Status', 'Phase', 'Study type', 'Countries', 'Public title', 
-        'Intervention', 'target_enrollment', 'web address', 'results yes no', 'results url link']
-
-df_cond = df[cols].reset_index(drop=True)
-
-#renaming columns to match old format so I don't have to change them throughout
-df_cond.columns = ['TrialID', 'Source_Register', 'Date_registration', 'Date_enrollement', 
-                   'retrospective_registration', 'Primary_sponsor', 'Recruitment_Status', 'Phase', 'Study_type', 
-                   'Countries', 'Public_title', 'Intervention', 'target_enrollment', 'web_address', 
-                   'has_results', 'results_url_link']
-
+#Row-level cleaning. If the stage output from a previous snapshot exists only new or changed trials are 
+#re-cleaned and merged into it. Only the columns the cleaning reads are compared, and if the cleaning code has 
+#changed since the stage output was made everything is cleaned again.
+from lib.data_cleaning import clean_ictrp, incremental_clean, ictrp_raw_cols, ictrp_clean_version
+from lib.stage_io import read_stage, write_stage, stage_schemas
+
+stage_path = parent + '/data/ictrp_stage/'
+
+try:
+    previous_cleaned = read_stage(stage_path + 'ictrp_rows.csv', stage_schemas['ictrp_rows'], 
+                                  dtype={'Phase': str, 'target_enrollment': 'Int64'})
+    stored_hashes = pd.read_csv(stage_path + 'ictrp_row_hashes.csv', index_col='TrialID', dtype=str)
+    previous_hashes, previous_version = stored_hashes.row_hash, stored_hashes.clean_version.iloc[0]
+except FileNotFoundError:
+    previous_cleaned, previous_hashes, previous_version = None, None, None
+
+clean_version = ictrp_clean_version()
+df_cond, ictrp_hashes, ictrp_delta = incremental_clean(df, clean_ictrp, previous_cleaned, previous_hashes, 
+                                                       cols=ictrp_raw_cols, version=clean_version, 
+                                                       previous_version=previous_version)
+
+os.makedirs(stage_path, exist_ok=True)
+write_stage(df_cond, stage_path + 'ictrp_rows.csv', stage_schemas['ictrp_rows'], index=False)
+ictrp_hashes.to_frame().assign(clean_version=clean_version).to_csv(stage_path + 'ictrp_row_hashes.csv')
+
+print(f'{len(ictrp_delta)} trials were added, changed or removed since the last snapshot')
 print(f'The ICTRP shows {len(df_cond)} trials')
 
 # +
@@ -97,6 +96,11 @@ df_cond_nc = df_cond[~(df_cond.TrialID.isin(replace_ids))].reset_index(drop=True
 additions = pd.read_excel(manual_data, sheet_name = 'additional_trials').drop('from', 
                                                                                      axis=1).reset_index(drop=True)
 
+#The manually added trials are already cleaned but some target sizes aren't numbers (like 'Drug: FOY-305'). Those 
+#count as not available, as missing ones do.
+additions['target_enrollment'] = pd.to_numeric(additions['target_enrollment'], errors='coerce').astype('Int64')
+additions['target_enrollment_not_available'] = additions['target_enrollment'].isnull()
+
 print(f'An additional {len(additions)} known preferred cross registrations were added to the data')
 
 df_cond_all = df_cond_nc.append(additions)
@@ -107,20 +111,9 @@ print(f'The final dataset is {len(df_cond_all)} trials')
 # +
 #This ensures our check for retrospective registration is accurate w/r/t cross-registrations
 
-c_r_comp_dates = c_reg[['trial_id_keep', 'cross_reg_date']].groupby('trial_id_keep', as_index=False).min()
-c_r_merged = c_r_comp_dates.merge(df_cond_nc[['TrialID', 'Date_registration', 'Date_enrollement']], 
-                                 left_on='trial_id_keep', right_on='TrialID', how='left')
-c_r_merged['earliest_reg'] = c_r_merged[['cross_reg_date', 'Date_registration']].min(axis=1)
-pre_reg = c_r_merged[c_r_merged.TrialID.notnull() & (c_r_merged.earliest_reg <= c_r_merged.Date_enrollement)].trial_id_keep.to_list()
+from lib.data_cleaning import cross_reg_retrospective
 
-ret_reg = c_r_merged[c_r_merged.TrialID.notnull() & ~(c_r_merged.earliest_reg <= c_r_merged.Date_enrollement)].trial_id_keep.to_list()
-ret_reg
-
-for index, row in df_cond_all.iterrows():
-    if row.TrialID in pre_reg:
-        df_cond_all.at[index, 'retrospective_registration'] = True
-    elif row.TrialID in ret_reg:
-        df_cond_all.at[index, 'retrospective_registration'] = False
+df_cond_all = cross_reg_retrospective(df_cond_all, c_reg, ictrp=df_cond_nc)
 
 # +
 #finally, add cross-registration field
@@ -142,142 +135,51 @@ df_cond_all['cross_registrations'] = df_cond_all['cross_registrations'].fillna('
 #semi-colons in the intervention field mess with CSV
 df_cond_all['Intervention'] = df_cond_all['Intervention'].str.replace(';', '')
 
-#Study Type
-obv_replace = ['Observational [Patient Registry]', 'observational', 'Observational Study']
-int_replace = ['interventional', 'Interventional clinical trial of medicinal product', 'Treatment', 
-               'INTERVENTIONAL', 'Intervention', 'Interventional Study', 'PMS']
-hs_replace = ['Health services reaserch', 'Health Services reaserch', 'Health Services Research']
+from lib.data_cleaning import normalize_vocab, study_type_vocab, phase_vocab, recruitment_vocab
 
-df_cond_all['Study_type'] = (df_cond_all['Study_type'].str.replace(' study', '')
-                             .replace(obv_replace, 'Observational').replace(int_replace, 'Interventional')
-                             .replace('Epidemilogical research', 'Epidemiological research')
-                             .replace(hs_replace, 'Health services research')
-                             .replace('Others,meta-analysis etc', 'Other'))
+#Study Type
+df_cond_all['Study_type'], unmapped_study_types = normalize_vocab(df_cond_all['Study_type'], study_type_vocab, 
+                                                                  preprocess=lambda x: x.replace(' study', ''))
 
 #phase
-df_cond_all['Phase'] = df_cond_all['Phase'].fillna('Not Applicable')
-na = ['0', 'Retrospective study', 'Not applicable', 'New Treatment Measure Clinical Study', 'Not selected', 
-      'Phase 0', 'Diagnostic New Technique Clincal Study', '0 (exploratory trials)', 'Not Specified']
-p1 = ['1', 'Early Phase 1', 'I', 'Phase-1', 'Phase I']
-p12 = ['1-2', '2020-02-01 00:00:00', 'Phase I/II', 'Phase 1 / Phase 2', 'Phase 1/ Phase 2',
-       'Human pharmacology (Phase I): yes\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): no\n']
-p2 = ['2', 'II', 'Phase II', 'IIb', 'Phase-2', 'Phase2',
-      'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): no\n']
-p23 = ['Phase II/III', '2020-03-02 00:00:00', 'II-III', 'Phase 2 / Phase 3', 'Phase 2/ Phase 3', '2-3',
-       'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): yes\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): no\n']
-p3 = ['3', 'Phase III', 'Phase-3', 'III',
-      'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): no\n']
-p34 = ['Phase 3/ Phase 4', 'Phase III/IV',
-       'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): yes\nTherapeutic use (Phase IV): yes\n']
-p4 = ['4', 'IV', 'Post Marketing Surveillance', 'Phase IV', 'PMS',
-      'Human pharmacology (Phase I): no\nTherapeutic exploratory (Phase II): no\nTherapeutic confirmatory - (Phase III): no\nTherapeutic use (Phase IV): yes\n']
-
-df_cond_all['Phase'] = (df_cond_all['Phase'].replace(na, 'Not Applicable').replace(p1, 'Phase 1')
-                        .replace(p12, 'Phase 1/Phase 2').replace(p2, 'Phase 2')
-                        .replace(p23, 'Phase 2/Phase 3').replace(p3, 'Phase 3').replace(p34, 'Phase 3/Phase 4')
-                        .replace(p4, 'Phase 4'))
+df_cond_all['Phase'], unmapped_phases = normalize_vocab(df_cond_all['Phase'], phase_vocab, 
+                                                        fill_value='Not Applicable')
 
 #Fixing Observational studies incorrectly given a Phase in ICTRP data
 m = ((df_cond_all.Phase.str.contains('Phase')) & (df_cond_all.Study_type == 'Observational'))
 df_cond_all['Phase'] = df_cond_all.Phase.where(~m, 'Not Applicable')
 
 #Recruitment Status
-df_cond_all['Recruitment_Status'] = df_cond_all['Recruitment_Status'].replace('Not recruiting', 'Not Recruiting')
-df_cond_all['Recruitment_Status'] = df_cond_all['Recruitment_Status'].fillna('No Status Given')
+df_cond_all['Recruitment_Status'], unmapped_statuses = normalize_vocab(df_cond_all['Recruitment_Status'], 
+                                                                       recruitment_vocab, 
+                                                                       fill_value='No Status Given')
 
 #Get rid of messy accents
-from lib.data_cleaning import norm_names
+from lib.data_cleaning import norm_names_categorical
     
-df_cond_all['Primary_sponsor'] = df_cond_all.Primary_sponsor.apply(norm_names)
+df_cond_all['Primary_sponsor'] = norm_names_categorical(df_cond_all.Primary_sponsor, 
+                                                        cache_path=parent + '/data/norm_names_cache.json')
 df_cond_all['Primary_sponsor'] = df_cond_all['Primary_sponsor'].replace('NA', 'No Sponsor Name Given')
 df_cond_all['Primary_sponsor'] = df_cond_all['Primary_sponsor'].replace('nan', 'No Sponsor Name Given')
 
+# +
+#Values the vocabularies don't cover are left as they are, so any new ones are listed here to be added to the 
+#vocabularies in lib.data_cleaning
+unmapped_vocab = pd.concat([unmapped_study_types.assign(column='Study_type'), 
+                            unmapped_phases.assign(column='Phase'), 
+                            unmapped_statuses.assign(column='Recruitment_Status')], ignore_index=True)
+
+if len(unmapped_vocab) > 0:
+    print('Update the vocabularies with these values and rerun')
+else:
+    print('All study types, phases and recruitment statuses mapped')
+unmapped_vocab
+
 # +
 #Countries
-df_cond_all['Countries'] = df_cond_all['Countries'].fillna('No Country Given').replace('??', 'No Country Given')
-
-china_corr = ['Chian', 'China?', 'Chinese', 'Wuhan', 'Chinaese', 'china', 'Taiwan, Province Of China', 
-              "The People's Republic of China"]
-
-country_values = df_cond_all['Countries'].tolist()
-
-new_list = []
-
-for c in country_values:
-    country_list = []
-    if isinstance(c, float):
-        country_list.append('No Sponsor Name Given')
-    elif c == 'No Sponsor Name Given':
-        country_list.append('No Sponsor Name Given')
-    elif c in china_corr:
-        country_list.append('China')
-    elif c in ['Iran (Islamic Republic of)', 'Iran, Islamic Republic of']:
-        country_list.append('Iran')
-    elif c in ['Viet nam', 'Viet Nam']:
-        country_list.append('Vietnam')
-    elif c in ['Korea, Republic of', 'Korea, Republic Of', 'KOREA'] :
-        country_list.append('South Korea')
-    elif c in ['USA', 'United States of America', 'U.S.']:
-        country_list.append('United States')
-    elif c == 'Japan,Asia(except Japan),Australia,Europe':
-        country_list = ['Japan', 'Australia', 'Asia', 'Europe']
-    elif c == 'Japan,Asia(except Japan),North America,South America,Australia,Europe,Africa':
-        country_list = ['Japan, Asia(except Japan), North America, South America, Australia, Europe, Africa']
-    elif c == 'The Netherlands':
-        country_list.append('Netherlands')
-    elif c == 'England':
-        country_list.append('United Kingdom')
-    elif c == 'Japan,North America':
-        country_list = ['Japan', 'North America']
-    elif c == 'Czechia':
-        country_list.append('Czech Republic')
-    elif c == 'ASIA':
-        country_list.append('Asia')
-    elif c == 'EUROPE':
-        country_list.append('Europe')
-    elif c == 'MALAYSIA':
-        country_list.append('Malaysia')
-    elif c in ['Congo', 'Congo, Democratic Republic', 'Congo, The Democratic Republic of the']:
-        country_list.append('Democratic Republic of Congo')
-    elif c in ["C√¥te D'Ivoire", 'Cote Divoire']:
-        country_list.append("Cote d'Ivoire")
-    elif ';' in c:
-        c_list = c.split(';')
-        unique_values = list(set(c_list))
-        for v in unique_values:
-            if v in china_corr:
-                country_list.append('China')
-            elif v in ['Iran (Islamic Republic of)', 'Iran, Islamic Republic of']:
-                country_list.append('Iran')
-            elif v in ['Korea, Republic of', 'Korea, Republic Of', 'KOREA']:
-                country_list.append('South Korea')
-            elif v in ['Viet nam', 'Viet Nam']:
-                country_list.append('Vietnam')
-            elif v in ['USA', 'United States of America']:
-                country_list.append('United States')
-            elif v == 'The Netherlands':
-                country_list.append('Netherlands')
-            elif v == 'England':
-                country_list.append('United Kingdom')
-            elif v == 'Czechia':
-                country_list.append('Czech Republic')
-            elif v == 'ASIA':
-                country_list.append('Asia')
-            elif v == 'EUROPE':
-                country_list.append('Europe')
-            elif v == 'MALAYSIA':
-                country_list.append('Malaysia')
-            elif v in ['Congo', 'Congo, Democratic Republic', 'Congo, The Democratic Republic of the']:
-                country_list.append('Democratic Republic of Congo')
-            elif v in ["C√¥te D'Ivoire", 'Cote Divoire']:
-                country_list.append("Cote d'Ivoire")
-            else:
-                country_list.append(v)
-    else:
-        country_list.append(c.strip())
-    new_list.append(', '.join(country_list))
-
-df_cond_all['Countries'] = new_list
+from lib.data_cleaning import normalize_countries, country_aliases
+
+df_cond_all['Countries'], trial_countries = normalize_countries(df_cond_all, country_aliases)
 
 # +
 #Normalizing sponsor names
@@ -332,12 +234,13 @@ df_cond_int.columns = col_names
 
 reorder = ['trialid', 'source_register', 'date_registration', 'date_enrollement', 'retrospective_registration', 
            'normed_spon_names', 'recruitment_status', 'phase', 'study_type', 'countries', 'public_title', 
-           'study_category', 'intervention', 'intervention_list', 'target_enrollment', 'web_address', 'cross_registrations']
+           'study_category', 'intervention', 'intervention_list', 'target_enrollment', 'target_enrollment_not_available', 
+           'web_address', 'cross_registrations']
 
 df_final = df_cond_int[reorder].reset_index(drop=True).drop_duplicates().reset_index()
 # -
 
-df_final.to_csv(parent + '/data/cleaned_ictrp_29June2020.csv', index=False)
+write_stage(df_final, parent + '/data/cleaned_ictrp_29June2020.csv', stage_schemas['cleaned_ictrp'], index=False)
 
 # +
 print(f'There are {len(df_final)} total unique registered studies on the ICTRP')
@@ -355,6 +258,6 @@ withdrawn = in_2020[~(in_2020.public_title.str.contains('Cancelled') | in_2020.p
 print(f'{len(withdrawn)} are not listed as cancelled/withdrawn. We exclude {len(in_2020) - len(withdrawn)} at this step but will exclude additional trials after scraping the registries')
 # -
 
-withdrawn.to_csv(parent + '/data/ictrp_with_exclusions_29Jul2020.csv')
+write_stage(withdrawn, parent + '/data/ictrp_with_exclusions_29Jul2020.csv', stage_schemas['ictrp_with_exclusions'])
 
 
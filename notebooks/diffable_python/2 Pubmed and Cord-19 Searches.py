@@ -36,106 +36,75 @@ import re
 import json
 import pandas as pd
 import numpy as np
-import xmltodict
 
 from bs4 import BeautifulSoup
-from xml.etree.ElementTree import tostring
 
 # +
-#If the archive exists, load it in.
-try:
-    from lib.id_searches import zip_load
-    archive_df = zip_load(parent + '/data/pubmed/pubmed_archive_1July_2020.csv.zip', 
-                  'pubmed_archive_1July_2020.csv', index_col = 0)
-
-#If it doesn't exist, you can do a new PubMed search
-except FileNotFoundError:
-    from pymed import PubMed
+#The PubMed archive is a Parquet file with the fields we need in their own columns and the raw XML of each 
+#article kept compressed alongside. If it exists, load it in.
+from lib.id_searches import zip_load, read_pubmed_archive, convert_pubmed_archive
+archive_path = parent + '/data/pubmed/pubmed_archive_1July_2020.parquet'
+csv_archive_path = parent + '/data/pubmed/pubmed_archive_1July_2020.csv.zip'
+
+#If only the original CSV archive of the 1 July 2020 search exists, it is converted so the same snapshot is used
+if not os.path.exists(archive_path) and os.path.exists(csv_archive_path):
+    convert_pubmed_archive(csv_archive_path, 'pubmed_archive_1July_2020.csv', archive_path)
+
+#If neither exists, you can do a new PubMed search. The results are fetched from the E-utilities in concurrent 
+#batches (throttled to NCBI's rate limit) and written straight to the archive.
+if not os.path.exists(archive_path):
+    #A new search is a different snapshot to the 1 July 2020 one, so it is saved under today's date
+    from datetime import date
+    archive_path = parent + '/data/pubmed/pubmed_archive_' + date.today().strftime('%d%B_%Y') + '.parquet'
+if not os.path.exists(archive_path):
     from lib.credentials import email
-    from lib.id_searches import query, create_pubmed_archive
+    from lib.id_searches import query
+    from lib.eutils import fetch_pubmed_archive
     print('Archive file not found, conduting new PubMed search.')
-    pubmed = PubMed(tool="Pymed", email=email)
-    results = pubmed.query(query, max_results=100000)
-    
-    print('Transforming results. This may take a few minutes')
-    results_list = list(results) #This can take a while
-    
-    archive_df = create_pubmed_archive(results_list)
-    archive_df.to_csv(parent + '/data/pubmed/pubmed_archive_1July_2020.csv')
-    
+    fetch_pubmed_archive(query, archive_path, email=email, max_results=100000)
+
+#Set this to True to fetch only what PubMed has added (by EDAT) or revised since the archive was last harvested. 
+#Records are upserted by PMID and only new or revised ones are scanned again below.
+update_archive = False
+changed = []
+if update_archive:
+    from lib.credentials import email
+    from lib.eutils import update_pubmed_archive
+    changes = update_pubmed_archive(archive_path, email=email)
+    changed = changes.pmid[changes.status != 'unchanged'].tolist()
 # -
 
-pubmed_data = archive_df.xml_json.tolist()
+#Only the columns we need are read, memory mapped
+pubmed_search_results = read_pubmed_archive(archive_path, columns=['pmid', 'doi', 'accession', 'abstract', 'pub_types'])
+pubmed_search_results['source'] = 'PubMed'
 
 # +
-pubmed_dicts = []
-for rec in tqdm(pubmed_data):
-    pm_dict = json.loads(rec)['PubmedArticle']
-    entry_dict = {}
-    art_ids = pm_dict['PubmedData']['ArticleIdList']['ArticleId']
-    entry_dict['source'] = 'PubMed'
-    entry_dict['pmid'] = pm_dict['MedlineCitation']['PMID']['#text']
-    entry_dict['doi'] = None
-    if isinstance(art_ids, list):
-        for x in art_ids:
-            if x['@IdType'] == 'doi':
-                entry_dict['doi'] = x['#text']
-    elif isinstance(art_ids, dict):
-        if art_ids['@IdType'] == 'doi':
-            entry_dict['doi'] = art_ids['#text']
-    try:
-        dbs =  pm_dict['MedlineCitation']['Article']['DataBankList']['DataBank']
-        accession_nums = []
-        if isinstance(dbs, list):
-            for x in dbs:
-                ans = x['AccessionNumberList']['AccessionNumber']
-                if isinstance(ans, list):
-                    accession_nums += ans
-                else:
-                    accession_nums.append(x)
-        elif isinstance(dbs, dict):
-            x = dbs['AccessionNumberList']['AccessionNumber']
-            if isinstance(x, list):
-                accession_nums += x
-            else:
-                accession_nums.append(x)
-                
-        if accession_nums:
-            entry_dict['accession'] = accession_nums
-        else:
-            entry_dict['accession'] = None
-    except KeyError:
-        entry_dict['accession'] = None
-    
-    try:
-        entry_dict['abstract'] = str(pm_dict['MedlineCitation']['Article']['Abstract']['AbstractText'])
-    except KeyError:
-        entry_dict['abstract'] = None
-    
-    try:
-        entry_dict['pub_types'] = pm_dict['MedlineCitation']['Article']['PublicationTypeList']
-    except KeyError:
-        entry_dict['pub_types'] = None
-    pubmed_dicts.append(entry_dict)
-
+#Our matcher compiles the lists of our regular expressions once
+#Each document is folded first (Unicode normalised, lower cased, dashes and whitespace evened out) so simpler, 
+#case sensitive versions of the patterns can be used. Hits are reported from the original text.
+#The scan results are kept between runs so only records that are new, revised or were scanned with different 
+#patterns get scanned again
+from lib.id_searches import RegistryMatcher, scan_pubmed_abstracts
 
-# +
-#Our searching function and lists of our regular expressions
-from lib.id_searches import search_text, ids_exact, prefixes, registry_names
+matcher = RegistryMatcher(folded=True)
 
-for d in tqdm(pubmed_dicts):
-    d['abst_id_hits'] = search_text(ids_exact, d['abstract'])
-    d['reg_prefix_hits'] = search_text(prefixes, d['abstract'])
-    d['reg_name_hits'] = search_text(registry_names, d['abstract'])
+scan_path = parent + '/data/pubmed/pubmed_scan_results.pkl'
+previous_scans = pd.read_pickle(scan_path) if os.path.exists(scan_path) else None
 
+pubmed_scans = scan_pubmed_abstracts(pubmed_search_results, matcher, previous_scans, rescan=changed)
+pubmed_scans.to_pickle(scan_path)
 
+pubmed_search_results = pubmed_search_results.merge(pubmed_scans.drop('versions', axis=1), how='left', on='pmid')
 # -
 
-pubmed_search_results = pd.DataFrame(pubmed_dicts)
+#How many documents and pattern lists the literal prefilter let us skip
+matcher.counters
 
 # +
-col_order = ['pmid', 'source', 'abst_id_hits', 'reg_prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi']
-col_rename = ['id', 'source', 'id_hits', 'prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi']
+col_order = ['pmid', 'source', 'abst_id_hits', 'reg_prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi', 
+             'hit_sections']
+col_rename = ['id', 'source', 'id_hits', 'prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi', 
+              'hit_sections']
 
 final_pubmed = pubmed_search_results[col_order].reset_index(drop=True)
 final_pubmed.columns = col_rename
@@ -143,24 +112,26 @@ final_pubmed['pm_id'] = final_pubmed['id']
 final_pubmed['cord_id'] = None
 # -
 
-final_pubmed.to_csv(parent + '/data/pubmed/pubmed_search_results.csv')
+#Saved as a stage, so the hit lists are JSON in the CSV and typed in the Parquet copy
+from lib.stage_io import write_stage, stage_schemas
+write_stage(final_pubmed, parent + '/data/pubmed/pubmed_search_results.csv', stage_schemas['pubmed_search_results'])
 
 # # Searching CORD-10 data
 
-metadata = zip_load(parent + '/data/cord_19/metadata.csv.zip', 'metadata.csv', low_memory = False)
-metadata['publish_time'] = pd.to_datetime(metadata['publish_time'])
-
 # +
-#Getting a list of all the filenames for the papers that were published in 2020
-covid_19_arts = metadata[metadata.publish_time >= pd.Timestamp(2020,1,1)].sha.to_list()
-covid_19_pmc = metadata[metadata.publish_time >= pd.Timestamp(2020,1,1)].pmcid.to_list()
-recent_articles = []
-for c in covid_19_arts:
-    recent_articles.append(str(c) + '.json')
+#We only need a few of the metadata columns and only the papers published from 2020 onwards, so the file is 
+#streamed in chunks keeping just those. engine='pyarrow' will parse it on multiple threads instead.
+metadata_cols = ['cord_uid', 'sha', 'pmcid', 'pubmed_id', 'doi', 'title', 'url', 'publish_time']
+#Every column is read as text, so PubMed IDs stay strings in every chunk
+metadata_dtypes = {c: str for c in metadata_cols}
 
-recent_pmcs = []
-for p in covid_19_pmc:
-    recent_pmcs.append(str(p) + '.xml.json')
+def published_2020(chunk):
+    return pd.to_datetime(chunk['publish_time']) >= pd.Timestamp(2020,1,1)
+
+metadata = zip_load(parent + '/data/cord_19/metadata.csv.zip', 'metadata.csv', usecols=metadata_cols, 
+                    dtype=metadata_dtypes, predicate=published_2020, chunksize=100000)
+metadata['publish_time'] = pd.to_datetime(metadata['publish_time'])
+# -
 
 # +
 #The CORD-19 document parses are too big to fit in the GitHub repo so you need to download and add locally
@@ -172,58 +143,61 @@ pdfs = os.listdir(path_pre + 'pdf_json')
 pmc = os.listdir(path_pre + 'pmc_json')
 
 # +
-#Now we can only pull out the recent articles from the pdfs
-overlap_pdf = list(set(recent_articles).intersection(set(pdfs)))
+#Many papers have both a PMC and a PDF parse, or several PDF parses, so rather than scanning them all and 
+#deduplicating afterwards we pick one parse per paper (cord_uid) published in 2020: the PMC parse if there is 
+#one, otherwise the first PDF sha
+from lib.id_searches import plan_cord_parses
 
-overlap_pmc = list(set(recent_pmcs).intersection(set(pmc)))
+recent = metadata[metadata.publish_time >= pd.Timestamp(2020,1,1)]
+cord_plan, plan_report = plan_cord_parses(recent, pdfs, pmc)
 
-# +
-#These are searches in the CORD-19 database and take roughly an hour to run both.
-from lib.id_searches import search_text, ids_exact, prefixes, registry_names
-
-cord_pdf_list = []
-
-for o in tqdm(overlap_pdf):
-    with open(path_pre + 'pdf_json' + '/' + o, 'r') as x:
-        doc_dict = {}
-        c_text = x.read()
-        a = json.loads(c_text)
-        doc_dict['file_name'] = a['paper_id']
-        doc_dict['source'] = 'cord_pdf'
-        doc_dict['id_hits'] = search_text(ids_exact, c_text)
-        doc_dict['reg_prefix_hits'] = search_text(prefixes, c_text)
-        doc_dict['reg_name_hits'] = search_text(registry_names, c_text)
-    cord_pdf_list.append(doc_dict)
+#A parse shared by several papers is only scanned once
+overlap_pdf = cord_plan.file_name[cord_plan.source == 'cord_pdf'].unique().tolist()
+overlap_pmc = cord_plan.file_name[cord_plan.source == 'cord_pmc'].unique().tolist()
+# -
+
+#The duplicate parses this saves us scanning
+plan_report
 
 # +
-cord_pmc_list = []
-
-for o in tqdm(overlap_pmc):
-    with open(path_pre + 'pmc_json' + '/' + o, 'r') as x:
-        doc_dict = {}
-        c_text = x.read()
-        a = json.loads(c_text)
-        doc_dict['file_name'] = a['paper_id']
-        doc_dict['source'] = 'cord_pmc'
-        doc_dict['id_hits'] = search_text(ids_exact, c_text)
-        doc_dict['reg_prefix_hits'] = search_text(prefixes, c_text)
-        doc_dict['reg_name_hits'] = search_text(registry_names, c_text)
-    cord_pmc_list.append(doc_dict)
+#These are searches in the CORD-19 database and took roughly an hour to run both serially.
+#The files are now spread across a pool of processes, one per core by default.
+#Only the text of each paper is scanned (not the JSON around it) and every hit is recorded against the 
+#section it was found in.
+#Results are cached by file contents and pattern version, so rerunning on a new CORD-19 release only scans the
+#parses that are new or changed (and only for pattern lists that have changed since the last run).
+from lib.id_searches import scan_cord_files, cord_sections
+
+scan_cache = parent + '/data/cord_19/scan_cache.sqlite'
+
+cord_pdf_list, pdf_counters = scan_cord_files(path_pre + 'pdf_json', overlap_pdf, 'cord_pdf', sections=cord_sections, 
+                                              cache_path=scan_cache, folded=True)
+# -
+
+cord_pmc_list, pmc_counters = scan_cord_files(path_pre + 'pmc_json', overlap_pmc, 'cord_pmc', sections=cord_sections, 
+                                              cache_path=scan_cache, folded=True)
 
 # +
+#Each parse is joined back to its paper through the plan, so papers with several shas get their metadata too
+cord_metadata = metadata.drop_duplicates('cord_uid')
+plan_ids = cord_plan[['parse_id', 'cord_uid']]
+
 cord_pmc_df = pd.DataFrame(cord_pmc_list)
 
-final_pmc = cord_pmc_df.merge(metadata, left_on='file_name', right_on='pmcid', how='left')
+final_pmc = cord_pmc_df.merge(plan_ids, left_on='file_name', right_on='parse_id', how='left').merge(
+    cord_metadata, on='cord_uid', how='left')
 
-# +
 cord_pdf_df = pd.DataFrame(cord_pdf_list)
 
-final_pdf = cord_pdf_df.merge(metadata, left_on='file_name', right_on='sha', how='left')
+final_pdf = cord_pdf_df.merge(plan_ids, left_on='file_name', right_on='parse_id', how='left').merge(
+    cord_metadata, on='cord_uid', how='left')
+# -
 
 # +
 col_order = ['id', 'source', 'id_hits', 'reg_prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi', 
-             'pubmed_id', 'cord_uid']
-col_names = ['id', 'source', 'id_hits', 'prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi', 'pm_id', 'cord_id']
+             'pubmed_id', 'cord_uid', 'hit_sections']
+col_names = ['id', 'source', 'id_hits', 'prefix_hits', 'reg_name_hits', 'accession', 'pub_types', 'doi', 'pm_id', 'cord_id', 
+             'hit_sections']
 
 interim_cord = final_pmc.append(final_pdf, ignore_index=True).reset_index(drop=True)
 
@@ -235,13 +209,27 @@ final_cord = interim_cord[col_order].reset_index(drop=True)
 final_cord.columns = col_names
 # -
 
-final_cord.to_csv(parent + '/data/cord_19/cord_19_search_results.csv')
+write_stage(final_cord, parent + '/data/cord_19/cord_19_search_results.csv', stage_schemas['cord_19_search_results'])
 
 # # Final Data Management
 
 combined_dataset = final_cord.append(final_pubmed, ignore_index=True)
 combined_dataset.head()
 
+# +
+#Index every hit by trial ID so "which papers mention this trial?" is a quick lookup rather than a scan of the 
+#final CSV. lookup_trial/lookup_trials/lookup_doc in lib.id_searches query it.
+#ID hits are indexed under their ICTRP TrialID, with a status saying whether they matched one.
+from lib.id_searches import build_hit_index, lookup_trial
+from lib.stage_io import read_stage, stage_schemas
+
+ictrp_ids = read_stage(parent + '/data/cleaned_ictrp_29June2020.csv', stage_schemas['cleaned_ictrp']).trialid
+
+build_hit_index(combined_dataset, parent + '/data/trial_hit_index.sqlite', known_ids=ictrp_ids)
+# -
+
+lookup_trial(parent + '/data/trial_hit_index.sqlite', 'NCT04280705')
+
 # +
 #need to turn the pub_types column into strings:
 from lib.id_searches import stringify
@@ -263,9 +251,11 @@ filter_5 = combined_dataset.pub_types.str.contains(re.compile('(?i)Trial'))
 filtered = combined_dataset[filter_1 | filter_2 | filter_3 | filter_4 | filter_5].sort_values('id').reset_index(drop=True).fillna(np.nan)
 
 # +
-from lib.id_searches import add_lists, make_doi_url, trial_pub_type
+from lib.id_searches import combine_lists, make_doi_url, trial_pub_type
 
-combined = filtered[['id', 'id_hits', 'prefix_hits', 'reg_name_hits', 'accession']].groupby('id').agg(add_lists).merge(
+#combine_lists gives the same lists as .groupby('id').agg(add_lists) but explodes the lists and groups once 
+#rather than concatenating them group by group
+combined = combine_lists(filtered, 'id', ['id_hits', 'prefix_hits', 'reg_name_hits', 'accession']).merge(
     filtered[['id', 'pub_types']][filtered.pub_types.notnull()], how='left', left_on='id', right_on='id').merge(
     filtered[['id', 'doi', 'pm_id']].drop_duplicates(), how='left', left_on='id', right_on='id').merge(
     filtered[['id','cord_id']][filtered.cord_id.notnull()].drop_duplicates(), how='left', left_on='id', right_on='id')
@@ -279,4 +269,4 @@ final = combined.merge(metadata[['cord_uid', 'url', 'title']], how='left', left_
 #Do a final dedupe
 final_deduped = final.drop_duplicates('id').reset_index(drop=True)
 
-final_deduped.to_csv(parent + '/data/final_auto_15Sept2020.csv')
+write_stage(final_deduped, parent + '/data/final_auto_15Sept2020.csv', stage_schemas['final_auto'])
@@ -51,7 +51,8 @@ save_path = parent + '/data/raw_scraping_output/'
 
 # The trials these were run on are those in the ICTRP dataset after the initial inclusions/exclusions were made (observational, pre-2020 trials, trials that are withdrawn/cancelled). This code assumes you read in that dataset to a DataFrame below and work from there.
 
-df = pd.read_csv(parent + '/data/ictrp_with_exclusions_29Jul2020.csv')
+from lib.stage_io import read_stage, stage_schemas
+df = read_stage(parent + '/data/ictrp_with_exclusions_29Jul2020.csv', stage_schemas['ictrp_with_exclusions'])
 df.source_register.unique()
 
 # # ClinicalTrials.gov
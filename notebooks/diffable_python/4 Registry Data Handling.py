@@ -26,11 +26,12 @@ sys.path.append(parent)
 import pandas as pd
 import re
 import numpy as np
+from lib.stage_io import read_stage, write_stage, stage_schemas
 
 # +
 reg = pd.read_excel(parent + '/data/registry_data/registry_data.xlsx', sheet_name='Full')
 
-ictrp = pd.read_csv(parent + '/data/cleaned_ictrp_29June2020.csv')
+ictrp = read_stage(parent + '/data/cleaned_ictrp_29June2020.csv', stage_schemas['cleaned_ictrp'])
 # -
 
 reg.columns
@@ -77,7 +78,7 @@ merged['relevant_comp_date'] = pd.to_datetime(merged['relevant_comp_date'])
 
 merged.head()
 
-merged.to_csv(parent + '/data/registry_data/registry_data_clean.csv')
+write_stage(merged, parent + '/data/registry_data/registry_data_clean.csv', stage_schemas['registry_data_clean'])
 
 
 
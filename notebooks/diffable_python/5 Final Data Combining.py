@@ -23,10 +23,9 @@ sys.path.append(parent)
 
 import pandas as pd
 import numpy as np
+from lib.stage_io import read_stage, write_stage, stage_schemas
 
-df = pd.read_csv(parent + '/data/cleaned_ictrp_29June2020.csv').drop('index', axis=1)
-
-df['date_registration'] = pd.to_datetime(df['date_registration'])
+df = read_stage(parent + '/data/cleaned_ictrp_29June2020.csv', stage_schemas['cleaned_ictrp']).drop('index', axis=1)
 
 df.head()
 
@@ -53,7 +52,7 @@ withdrawn = ~((df.public_title.str.contains('Cancelled')) | df.public_title.str.
 
 df['included'] = np.where(int_prev & in_2020 & withdrawn, 1, 0)
 
-registry_data = pd.read_csv(parent + '/data/registry_data/registry_data_clean.csv')
+registry_data = read_stage(parent + '/data/registry_data/registry_data_clean.csv', stage_schemas['registry_data_clean'])
 
 registry_data.head()
 
@@ -82,9 +81,15 @@ auto_hits = pd.read_csv(parent + '/data/screening_hit_results.csv')
 
 # Note:
 #
-# We have to change EUCTR2020-000890-25 to "EUCTR2020-000890-25-FR" and "EUCTR2020-001934-37" to "EUCTR2020-001934-37-ES" to match how they appear in the ICTRP for merging
+# Hits are put in the form the ICTRP uses for its TrialIDs so they can be merged. This includes EUCTR IDs without a country suffix, e.g. EUCTR2020-000890-25 becomes "EUCTR2020-000890-25-FR" and "EUCTR2020-001934-37" becomes "EUCTR2020-001934-37-ES", as they appear in the ICTRP.
+
+# +
+from lib.id_searches import canonical_trial_ids
 
-auto_hits['trn_1'] = auto_hits['trn_1'].str.replace('EUCTR2020-000890-25', 'EUCTR2020-000890-25-FR').str.replace('EUCTR2020-001934-37', 'EUCTR2020-001934-37-ES')
+trn_1 = canonical_trial_ids(auto_hits['trn_1'], df.trialid)
+auto_hits['trn_1'] = trn_1.trial_id.fillna(auto_hits['trn_1'])
+trn_1.match_status.value_counts()
+# -
 
 # +
 #Here we remove the record PMID32339248 as this was a duplicate PubMed entry to 32330277. 
@@ -168,7 +173,7 @@ df_final.head()
 
 df_final.round_inclusion.sum()
 
-df_final.to_csv(parent + '/data/final_dataset.csv')
+write_stage(df_final, parent + '/data/final_dataset.csv', stage_schemas['final_dataset'])
 
 
 
@@ -0,0 +1,16 @@
+import pytest
+from fake_eutils import FakeEutils
+
+@pytest.fixture
+def fake_eutils():
+    #Starts a FakeEutils server for the test and shuts it down afterwards
+    servers = []
+
+    def start(articles, **kwargs):
+        server = FakeEutils(articles, **kwargs).__enter__()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__()
@@ -0,0 +1,127 @@
+import json
+import re
+import threading
+import time
+from xml.etree.ElementTree import fromstring
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#A stand-in for the E-utilities that serves a fixed set of articles from a local thread, so the client's
+#throughput, throttling and backpressure can be tested offline
+def fake_date(tag, d, attributes=''):
+    return f'<{tag}{attributes}><Year>{d[0]}</Year><Month>{d[1]}</Month><Day>{d[2]}</Day></{tag}>'
+
+def fake_article(pmid, abstract='', edat=(2020, 5, 1), revised=None):
+    revised = fake_date('DateRevised', revised) if revised else ''
+    edat = fake_date('PubMedPubDate', edat, ' PubStatus="entrez"')
+    return (f'<PubmedArticle><MedlineCitation><PMID Version="1">{pmid}</PMID>{revised}<Article><Abstract>'
+            f'<AbstractText>{abstract}</AbstractText></Abstract></Article></MedlineCitation><PubmedData><History>'
+            f'{edat}</History><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList>'
+            f'</PubmedData></PubmedArticle>')
+
+def fake_article_date(elem):
+    if elem is None:
+        return None
+    return '/'.join(elem.findtext(part).zfill(2) for part in ['Year', 'Month', 'Day'])
+
+class FakeEutils:
+    #Answers esearch with the articles inside the query's EDAT window (or, with datetype=mdat, revised inside
+    #mindate/maxdate) and efetch with the requested slice of them. Requests over per_second in any one second get
+    #a 429 like NCBI gives, and latency is added to every response. articles can be swapped between searches.
+    def __init__(self, articles, per_second=None, latency=0):
+        self.articles = articles
+        self.per_second = per_second
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.request_times = []
+        self.counters = {'esearch': 0, 'efetch': 0, 'rejected': 0, 'in_flight': 0, 'max_in_flight': 0}
+        self.histories = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            self.request_times = [t for t in self.request_times if now - t < 1]
+            if self.per_second is not None and len(self.request_times) >= self.per_second:
+                self.counters['rejected'] += 1
+                return False
+            self.request_times.append(now)
+            self.counters['in_flight'] += 1
+            self.counters['max_in_flight'] = max(self.counters['max_in_flight'], self.counters['in_flight'])
+            return True
+
+    def respond(self, path, params):
+        if path.endswith('esearch.fcgi'):
+            self.counters['esearch'] += 1
+            found = self.search(params)
+            with self.lock:
+                query_key = str(len(self.histories) + 1)
+                self.histories[query_key] = found
+            result = {'esearchresult': {'count': str(len(found)), 'webenv': 'FAKE', 'querykey': query_key}}
+            return 'application/json', json.dumps(result)
+        elif path.endswith('efetch.fcgi'):
+            self.counters['efetch'] += 1
+            found = self.histories[params['query_key'][0]]
+            start = int(params.get('retstart', ['0'])[0])
+            stop = start + int(params.get('retmax', ['20'])[0])
+            return 'text/xml', '<PubmedArticleSet>' + ''.join(found[start:stop]) + '</PubmedArticleSet>'
+        else:
+            return None
+
+    def search(self, params):
+        window = re.search(r'"([\d/]+)"\[EDAT\] : "([\d/]+)"\[EDAT\]', params.get('term', [''])[0])
+        edat_window = (window.group(1), window.group(2)) if window else ('0000/00/00', '9999/99/99')
+        found = []
+        for article in self.articles:
+            element = fromstring(article)
+            edat = fake_article_date(element.find("PubmedData/History/PubMedPubDate[@PubStatus='entrez']"))
+            if not edat_window[0] <= edat <= edat_window[1]:
+                continue
+            if params.get('datetype') == ['mdat']:
+                revised = fake_article_date(element.find('MedlineCitation/DateRevised'))
+                if not (revised and params['mindate'][0] <= revised <= params['maxdate'][0]):
+                    continue
+            found.append(article)
+        return found
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not fake.admit():
+                    self.send_response(429)
+                    self.end_headers()
+                    return
+                try:
+                    time.sleep(fake.latency)
+                    url = urlparse(self.path)
+                    answer = fake.respond(url.path, parse_qs(url.query))
+                    if answer is None:
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                    body = answer[1].encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', answer[0])
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with fake.lock:
+                        fake.counters['in_flight'] -= 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
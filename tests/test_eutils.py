@@ -0,0 +1,42 @@
+import asyncio
+import time
+from fake_eutils import fake_article
+from lib.eutils import EutilsClient, fetch_pubmed_archive
+from lib.id_searches import read_pubmed_archive
+
+articles = [fake_article(i, f'Registered as NCT0428{i:04d}') for i in range(1, 301)]
+
+def test_default_throttle_stays_under_the_limit(fake_eutils, tmp_path):
+    server = fake_eutils(articles, per_second=3)
+    counters = fetch_pubmed_archive('covid', str(tmp_path / 'archive.parquet'), base_url=server.base_url, 
+                                    batch_size=50)
+    assert server.counters['rejected'] == 0
+    assert counters['retries'] == 0
+    assert len(read_pubmed_archive(str(tmp_path / 'archive.parquet'), columns=['pmid'])) == len(articles)
+
+def test_rejected_requests_are_retried(fake_eutils, tmp_path):
+    server = fake_eutils(articles, per_second=3)
+    counters = fetch_pubmed_archive('covid', str(tmp_path / 'archive.parquet'), base_url=server.base_url, 
+                                    per_second=50, concurrency=4, batch_size=60)
+    assert server.counters['rejected'] > 0
+    assert counters['retries'] == server.counters['rejected']
+    pmids = read_pubmed_archive(str(tmp_path / 'archive.parquet'), columns=['pmid']).pmid
+    assert sorted(pmids.astype(int)) == list(range(1, 301))
+
+def test_in_flight_requests_and_queued_batches_are_bounded(fake_eutils):
+    server = fake_eutils(articles, latency=0.05)
+    client = EutilsClient(base_url=server.base_url, concurrency=2, per_second=100)
+    written = []
+    ahead = []
+
+    def slow_write(records):
+        #How many batches have been fetched but not yet written
+        ahead.append(server.counters['efetch'] - len(written))
+        time.sleep(0.1)
+        written.append(len(records))
+
+    asyncio.run(client.harvest('covid', slow_write, batch_size=20, queue_size=1))
+    assert sum(written) == len(articles)
+    assert server.counters['max_in_flight'] <= 2
+    #One batch being written, one in the queue and one waiting to be queued by each fetcher
+    assert max(ahead) <= 1 + 1 + 2
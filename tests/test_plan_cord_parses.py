@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+from lib.id_searches import plan_cord_parses
+
+def metadata(rows):
+    return pd.DataFrame(rows, columns=['cord_uid', 'sha', 'pmcid']).replace({None: np.nan})
+
+def planned(plan):
+    return {u: f for u, f in zip(plan.cord_uid, plan.file_name)}
+
+def test_prefers_pmc_then_first_available_sha():
+    meta = metadata([['u1', 'aaa; bbb', 'PMC1'], ['u2', 'ccc; ddd', None], ['u3', 'eee', None]])
+    plan, report = plan_cord_parses(meta, ['aaa.json', 'bbb.json', 'ddd.json', 'eee.json'], ['PMC1.xml.json'])
+    assert planned(plan) == {'u1': 'PMC1.xml.json', 'u2': 'ddd.json', 'u3': 'eee.json'}
+    assert report['parses_available'] == 5
+    assert report['parses_scanned'] == 3
+    assert report['duplicate_parses_skipped'] == 2
+
+def test_shared_sha_is_kept_for_a_paper_with_no_other_parse():
+    #u1 lists ccc but is scanned through its PMC parse; u4 only has ccc
+    meta = metadata([['u1', 'aaa; ccc', 'PMC1'], ['u4', 'ccc', None]])
+    plan, report = plan_cord_parses(meta, ['aaa.json', 'ccc.json'], ['PMC1.xml.json'])
+    assert planned(plan) == {'u1': 'PMC1.xml.json', 'u4': 'ccc.json'}
+    assert report['parses_scanned'] == 2
+
+def test_shared_sha_is_scanned_once():
+    meta = metadata([['u1', 'ccc', None], ['u4', 'ccc', None]])
+    plan, report = plan_cord_parses(meta, ['ccc.json'], [])
+    assert planned(plan) == {'u1': 'ccc.json', 'u4': 'ccc.json'}
+    assert report['parses_scanned'] == 1
+    assert report['duplicate_parses_skipped'] == 0
@@ -0,0 +1,30 @@
+import random
+import pytest
+from lib.id_searches import RegistryMatcher
+
+unspaced_ids = ['JapicCTI-205238', 'NCT04312345', 'ChiCTR2000029308', 'ISRCTN12345678', 'DRKS00021234',
+                'ACTRN12620000445976', 'IRCT20200310046738N1', 'CTRI/2020/04/024000', 'jRCT2031190264',
+                'UMIN000040000', 'KCT0005123', 'TCTR20200401002', 'PACTR202004567890123', 'EudraCT2020-001234-56']
+
+pieces = unspaced_ids + ['Japic CTI-205238', 'nct 0', 'EudraCT ', 'clinicaltrials.gov',
+                         'European Union Clinical Trials Register', 'abc', ' ', '-', ' (', '\n']
+
+class UnfilteredMatcher(RegistryMatcher):
+    #Runs every pattern on every document
+    def prefilter(self, to_search, kinds):
+        return {kind: tuple(range(len(self.pattern_lists[kind][0]))) for kind in kinds}
+
+@pytest.mark.parametrize('trial_id', unspaced_ids)
+def test_folded_matches_unfolded(trial_id):
+    text = f'Registered as {trial_id}.'
+    assert RegistryMatcher(folded=True).search(text) == RegistryMatcher().search(text)
+    assert RegistryMatcher(folded=True).search(text)['id_hits']
+
+@pytest.mark.parametrize('folded', [False, True])
+def test_prefilter_keeps_every_hit(folded):
+    matcher = RegistryMatcher(folded=folded)
+    unfiltered = UnfilteredMatcher(folded=folded)
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 8)))
+        assert matcher.search(text) == unfiltered.search(text), text